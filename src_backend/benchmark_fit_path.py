@@ -0,0 +1,15 @@
+import time
+
+import numpy as np
+
+from fit_path_and_velocity import fit_path
+
+# Benchmark fit_path with many intermediate positions, the banded solve should scale linearly
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    for num_intermediate_pos in [10, 100, 1000, 10000, 100000]:
+        intermediate_pos = np.cumsum(rng.normal(size=(num_intermediate_pos, 3)), axis=0)
+        start_time = time.perf_counter()
+        fit_path(intermediate_pos[0,:] - 1, np.ones(3), np.zeros(3), intermediate_pos[-1,:] + 1, np.ones(3), np.zeros(3), intermediate_pos)
+        elapsed_time = time.perf_counter() - start_time
+        print(f'{num_intermediate_pos:>7d} intermediate positions: {elapsed_time*1000:9.2f} ms, {elapsed_time/num_intermediate_pos*1e6:6.2f} us per position')
@@ -1,143 +1,248 @@
+from functools import lru_cache
 import numpy as np
 
 bezier_mat_3 = np.array([[-1,3,-3,1], [3,-6,3,0], [-3,3,0,0], [1,0,0,0]])
 bezier_mat_4 = np.array([[1,-4,6,-4,1], [-4,12,-12,4,0], [6,-12,6,0,0], [-4,4,0,0,0], [1,0,0,0,0]])
 bezier_mat_5 = np.array([[-1,5,-10,10,-5,1], [5,-20,30,-20,5,0], [-10,30,-30,10,0,0], [10,-20,10,0,0,0], [-5,5,0,0,0,0], [1,0,0,0,0,0]])
 
+# Basis matrices keyed by the number of control points. The power basis [t**n, ..., t, 1]
+# is differentiated once (twice) and the resulting constants are folded into the rows of
+# the derivative matrices, so every evaluation is np.vander(ts) @ basis matrix (@ p).
+bezier_mats = {4: bezier_mat_3, 5: bezier_mat_4, 6: bezier_mat_5}
+d_bezier_mats = {num_control_point: np.arange(num_control_point-1, 0, -1)[:, None] * mat[:-1] \
+                 for num_control_point, mat in bezier_mats.items()}
+dd_bezier_mats = {num_control_point: (np.arange(num_control_point-1, 1, -1) * np.arange(num_control_point-2, 0, -1))[:, None] * mat[:-2] \
+                  for num_control_point, mat in bezier_mats.items()}
+
+# Gauss-Legendre nodes and weights mapped from [-1, 1] to [0, 1], used for arc length quadrature
+gauss_legendre_order = 8
+gauss_legendre_nodes, gauss_legendre_weights = np.polynomial.legendre.leggauss(gauss_legendre_order)
+gauss_legendre_nodes = (gauss_legendre_nodes + 1) / 2
+gauss_legendre_weights = gauss_legendre_weights / 2
+
+
+def _power_basis_coeff(mats, p, ts):
+    '''
+    Multiply the power basis of every t in ts with the basis matrix in mats that matches p
+    p is a num_control_point-by-num_dimension array
+    ts is a 1D array of t between 0 and 1
+    '''
+    num_control_point = np.size(p, 0)
+    if num_control_point not in mats:
+        raise ValueError("Only Bezier curves with 4, 5, or 6 control points are supported.")
+    mat = mats[num_control_point]
+    return np.vander(np.atleast_1d(np.asarray(ts, dtype=float)), np.size(mat, 0)) @ mat
+
+
+def bezier_coeff_batch(p, ts):
+    '''
+    p is a num_control_point-by-num_dimension array
+    ts is a 1D array of t between 0 and 1
+    return a len(ts)-by-num_control_point array
+    '''
+    return _power_basis_coeff(bezier_mats, p, ts)
+
+def d_bezier_coeff_batch(p, ts):
+    '''
+    p is a num_control_point-by-num_dimension array
+    ts is a 1D array of t between 0 and 1
+    return a len(ts)-by-num_control_point array
+    '''
+    return _power_basis_coeff(d_bezier_mats, p, ts)
+
+def dd_bezier_coeff_batch(p, ts):
+    '''
+    p is a num_control_point-by-num_dimension array
+    ts is a 1D array of t between 0 and 1
+    return a len(ts)-by-num_control_point array
+    '''
+    return _power_basis_coeff(dd_bezier_mats, p, ts)
+
+def bezier_batch(p, ts):
+    '''
+    p is a num_control_point-by-num_dimension array
+    ts is a 1D array of t between 0 and 1
+    return a len(ts)-by-num_dimension array
+    '''
+    return bezier_coeff_batch(p, ts) @ p
+
+def d_bezier_batch(p, ts):
+    '''
+    p is a num_control_point-by-num_dimension array
+    ts is a 1D array of t between 0 and 1
+    return a len(ts)-by-num_dimension array
+    '''
+    return d_bezier_coeff_batch(p, ts) @ p
+
 
 def bezier(p, t):
     '''
     p is a num_control_point-by-num_dimension array
     t between 0 and 1
     '''
-    if np.size(p,0) == 4:
-        return np.array([t**3, t**2, t**1, 1]) @ bezier_mat_3 @ p
-    elif np.size(p,0) == 5:
-        return np.array([t**4, t**3, t**2, t**1, 1]) @ bezier_mat_4 @ p
-    elif np.size(p,0) == 6:
-        return np.array([t**5, t**4, t**3, t**2, t**1, 1]) @ bezier_mat_5 @ p
+    return bezier_batch(p, t)[0]
     
 def bezier_coeff(p, t):
     '''
     p is a num_control_point-by-num_dimension array
     t between 0 and 1
     '''
-    if np.size(p,0) == 4:
-        return np.array([t**3, t**2, t**1, 1]) @ bezier_mat_3
-    elif np.size(p,0) == 5:
-        return np.array([t**4, t**3, t**2, t**1, 1]) @ bezier_mat_4
-    elif np.size(p,0) == 6:
-        return np.array([t**5, t**4, t**3, t**2, t**1, 1]) @ bezier_mat_5
+    return bezier_coeff_batch(p, t)[0]
 
 def d_bezier(p, t):
     '''
     p is a num_control_point-by-num_dimension array
     t between 0 and 1
     '''
-    if np.size(p,0) == 4:
-        return np.array([3*t**2, 2*t, 1, 0]) @ bezier_mat_3 @ p
-    elif np.size(p,0) == 5:
-        return np.array([4*t**3, 3*t**2, 2*t, 1, 0]) @ bezier_mat_4 @ p
-    elif np.size(p,0) == 6:
-        return np.array([5*t**4, 4*t**3, 3*t**2, 2*t, 1, 0]) @ bezier_mat_5 @ p
+    return d_bezier_batch(p, t)[0]
 
 def d_bezier_coeff(p, t):
     '''
     p is a num_control_point-by-num_dimension array
     t between 0 and 1
     '''
-    if np.size(p,0) == 4:
-        return np.array([3*t**2, 2*t, 1, 0]) @ bezier_mat_3
-    elif np.size(p,0) == 5:
-        return np.array([4*t**3, 3*t**2, 2*t, 1, 0]) @ bezier_mat_4
-    elif np.size(p,0) == 6:
-        return np.array([5*t**4, 4*t**3, 3*t**2, 2*t, 1, 0]) @ bezier_mat_5
+    return d_bezier_coeff_batch(p, t)[0]
     
 def dd_bezier_coeff(p, t):
     '''
     p is a num_control_point-by-num_dimension array
     t between 0 and 1
     '''
-    if np.size(p,0) == 4:
-        return np.array([6*t, 2, 0, 0]) @ bezier_mat_3
-    elif np.size(p,0) == 5:
-        return np.array([12*t**2, 6*t, 2, 0, 0]) @ bezier_mat_4
-    elif np.size(p,0) == 6:
-        return np.array([20*t**3, 12*t**2, 6*t, 2, 0, 0]) @ bezier_mat_5
+    return dd_bezier_coeff_batch(p, t)[0]
 
 
-def bezier_arc_length(p, t_start, t_end):
+def _speed_integral(p, seg_starts, seg_ends):
     '''
-    Iteratively slice the curve into smaller and smaller parts to calculate curve length
-    until the length change is below a threshold
+    Gauss-Legendre estimate of the integral of |B'(t)| over every [seg_starts[i], seg_ends[i]]
     p is a num_control_point-by-num_dimension array
-    t_start and t_end between 0 and 1, t_end>t_start
+    seg_starts and seg_ends are 1D arrays of the same length
     '''
-    length_change_threshold_percent = 0.0001
-    initial_num_t_step = 200
-
-    length_change_threshold = 1/2*(np.linalg.norm(p[0,:] - p[1,:]) + np.linalg.norm(p[2,:] - p[3,:])) \
-                              *length_change_threshold_percent
-    length_change = np.inf
-    last_length = -np.inf
-    cur_num_t_step = initial_num_t_step
+    widths = seg_ends - seg_starts
+    seg_ts = seg_starts[:, None] + widths[:, None] * gauss_legendre_nodes[None, :]
+    speeds = np.linalg.norm(d_bezier_batch(p, seg_ts.ravel()), axis=1).reshape(seg_ts.shape)
+    return widths * (speeds @ gauss_legendre_weights)
 
-    for i in range(4):
-        if length_change <= length_change_threshold:
-            break
-        last_pos = bezier(p, t_start)
-        total_length = 0
-        for t_i in range(cur_num_t_step):
-            next_pos = bezier(p, (t_i+1) / cur_num_t_step * (t_end - t_start) + t_start)
-            total_length = total_length + np.linalg.norm(last_pos - next_pos)
-            last_pos = next_pos
-        length_change = total_length - last_length
-        # print(cur_num_t_step, last_length, total_length, length_change)
-        last_length = total_length
-        cur_num_t_step = cur_num_t_step * 2
 
-    return last_length
+def _adaptive_speed_integral(p, seg_starts, seg_ends, length_err_threshold, max_num_subdivision = 30):
+    '''
+    Integrate |B'(t)| over every [seg_starts[i], seg_ends[i]] with adaptive Gauss-Legendre quadrature.
+    Every interval is compared with the sum over its two halves and is accepted once the
+    difference is below its share (by width) of length_err_threshold, otherwise it is bisected.
+    All intervals of one subdivision level are evaluated together.
+    p is a num_control_point-by-num_dimension array
+    seg_starts and seg_ends are 1D arrays of the same length, seg_ends>=seg_starts
+    '''
+    seg_starts = np.asarray(seg_starts, dtype=float)
+    seg_ends = np.asarray(seg_ends, dtype=float)
+    total_width = np.sum(seg_ends - seg_starts)
+    lengths = np.zeros(np.size(seg_starts))
+    if total_width == 0:
+        return lengths
+
+    owners = np.arange(np.size(seg_starts))
+    seg_lengths = _speed_integral(p, seg_starts, seg_ends)
+    for i in range(max_num_subdivision):
+        seg_mids = (seg_starts + seg_ends) / 2
+        halves = _speed_integral(p, np.concatenate((seg_starts, seg_mids)), np.concatenate((seg_mids, seg_ends)))
+        left_lengths, right_lengths = np.split(halves, 2)
+        refined_lengths = left_lengths + right_lengths
+        # Non-finite lengths (e.g. from nan control points) can not improve by bisecting
+        is_converged = (np.abs(refined_lengths - seg_lengths) <= length_err_threshold * (seg_ends - seg_starts) / total_width) | ~np.isfinite(refined_lengths)
+        lengths += np.bincount(owners[is_converged], weights=refined_lengths[is_converged], minlength=np.size(lengths))
+        if np.all(is_converged):
+            return lengths
+
+        # Split the intervals that have not converged into their two halves
+        not_converged = ~is_converged
+        owners = np.concatenate((owners[not_converged], owners[not_converged]))
+        seg_starts, seg_ends = np.concatenate((seg_starts[not_converged], seg_mids[not_converged])), \
+                               np.concatenate((seg_mids[not_converged], seg_ends[not_converged]))
+        seg_lengths = np.concatenate((left_lengths[not_converged], right_lengths[not_converged]))
+
+    return lengths + np.bincount(owners, weights=seg_lengths, minlength=np.size(lengths))
+
+
+def bezier_arc_length(p, t_start, t_end, length_err_threshold_percent = 1e-8):
+    '''
+    Calculate curve length by integrating |B'(t)| with adaptive Gauss-Legendre quadrature.
+    The error threshold is length_err_threshold_percent of the control polygon length, which
+    bounds the curve length.
+    p is a num_control_point-by-num_dimension array
+    t_start and t_end between 0 and 1, t_end>t_start
+    '''
+    if t_end < t_start:
+        t_start, t_end = t_end, t_start
+    control_polygon_length = np.sum(np.linalg.norm(np.diff(p, axis=0), axis=1))
+    length_err_threshold = control_polygon_length * length_err_threshold_percent
+    return _adaptive_speed_integral(p, np.array([t_start]), np.array([t_end]), length_err_threshold)[0]
+
+
+class Bezier_Arc_Length_Index:
+    def __init__(self, p, num_table_segment = 64, length_err_threshold_percent = 1e-8):
+        '''
+        Table of cumulative arc length at evenly spaced t, used to map distance along the curve back to t
+        p is a num_control_point-by-num_dimension array
+        '''
+        self.p = np.array(p, dtype=float)
+        self.table_ts = np.linspace(0, 1, num_table_segment+1)
+        control_polygon_length = np.sum(np.linalg.norm(np.diff(self.p, axis=0), axis=1))
+        table_seg_lengths = _adaptive_speed_integral(self.p, self.table_ts[:-1], self.table_ts[1:], \
+                                                     control_polygon_length * length_err_threshold_percent)
+        self.table_lengths = np.concatenate(([0.0], np.cumsum(table_seg_lengths)))
+        self.total_length = self.table_lengths[-1]
+
+
+    def t_and_length(self, s, length_err_threshold_percent = 1e-7, max_num_newton_iteration = 10):
+        '''
+        Calculates the t between 0 and 1 that travels along the curve by each distance in s.
+        The table segment holding s is found with searchsorted, then Newton iterations run inside it.
+        s is a 1D array, distances beyond the curve length are clipped to it
+        return t, actual length along curve, and length error, each a 1D array
+        '''
+        s = np.clip(np.atleast_1d(np.asarray(s, dtype=float)), 0, self.total_length)
+        seg_i = np.clip(np.searchsorted(self.table_lengths, s, side='left') - 1, 0, np.size(self.table_ts) - 2)
+        seg_t_start, seg_t_end = self.table_ts[seg_i], self.table_ts[seg_i+1]
+        seg_length_start = self.table_lengths[seg_i]
+        seg_length = self.table_lengths[seg_i+1] - seg_length_start
+        length_err_threshold = self.total_length * length_err_threshold_percent
+
+        # Initial guess by linear interpolation inside the table segment
+        percent_in_seg = np.divide(s - seg_length_start, seg_length, out=np.zeros_like(s), where=seg_length > 0)
+        t = seg_t_start + percent_in_seg * (seg_t_end - seg_t_start)
+        for i in range(max_num_newton_iteration):
+            cur_curve_length_at_t = seg_length_start + _speed_integral(self.p, seg_t_start, t)
+            length_err = cur_curve_length_at_t - s
+            if np.all(np.abs(length_err) < length_err_threshold):
+                break
+            derivative = np.linalg.norm(d_bezier_batch(self.p, t), axis=1)
+            step = np.divide(length_err, derivative, out=np.zeros_like(t), where=derivative > 0)
+            t = np.clip(t - step, seg_t_start, seg_t_end)
+
+        return t, cur_curve_length_at_t, length_err
+
+
+@lru_cache(maxsize=256)
+def _cached_arc_length_index(shape, control_point_bytes):
+    return Bezier_Arc_Length_Index(np.frombuffer(control_point_bytes).reshape(shape))
+
+
+def get_arc_length_index(p):
+    '''
+    Return the Bezier_Arc_Length_Index of p, built once per distinct control point array
+    '''
+    p = np.ascontiguousarray(p, dtype=float)
+    return _cached_arc_length_index(p.shape, p.tobytes())
 
 
 def t(p, s):
     '''
     Calculates the t between 0 and 1 that travels along the curve by distance s
-    Based on https://medium.com/@ommand/movement-along-the-curve-with-constant-speed-4fa383941507
     p is a num_control_point-by-num_dimension array
     return t, actual length along curve, length error (np.inf if s > curve length)
     '''
-    length_err_threshold_percent = 0.00001
-
-    t_upper_bound = 1
-    t_lower_bound = 0
-
-    arc_total_length = bezier_arc_length(p, 0, 1)
-    length_err_threshold = arc_total_length * length_err_threshold_percent
-    if s > arc_total_length:
-        return (1, arc_total_length, np.inf)
-    
-    t = s / arc_total_length
-
-    for i in range(100):
-        cur_curve_length_at_t = bezier_arc_length(p, 0, t)
-        length_err = cur_curve_length_at_t - s
-        if np.abs(length_err) < length_err_threshold:
-            return t, cur_curve_length_at_t, length_err
-        
-        derivative = np.linalg.norm(d_bezier(p, t))
-        new_t = t - length_err / derivative
-
-        if length_err > 0:
-            t_upper_bound = t
-            if new_t < 0:
-                t = (t_upper_bound + t_lower_bound) / 2
-            else:
-                t = new_t
-        else:
-            t_lower_bound = t
-            if new_t > 1:
-                t = (t_upper_bound + t_lower_bound) / 2
-            else:
-                t = new_t
+    arc_length_index = get_arc_length_index(p)
+    if s > arc_length_index.total_length:
+        return (1, arc_length_index.total_length, np.inf)
     
-    return t, cur_curve_length_at_t, length_err
+    t, cur_curve_length_at_t, length_err = arc_length_index.t_and_length(s)
+    return t[0], cur_curve_length_at_t[0], length_err[0]
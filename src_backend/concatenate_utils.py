@@ -3,7 +3,9 @@ import numpy as np
 from scipy.spatial.transform import Rotation
 import os
 
-from orientation_quaternion import rotation_order
+from orientation_quaternion import rotation_order, get_orientation_transition_indexes_and_ts, get_orientation_mats_along_rotation_path, get_path_coord_zero_orientation_mat
+from fit_path_and_velocity import get_distances, get_path_curve_indexes_and_ts
+from bezier_curve import bezier_batch, d_bezier_batch
 
 def get_cur_frame_dict(cam_instrinsic_params, pos, rot, frame_name):
     fx, fy, width, height = cam_instrinsic_params
@@ -313,6 +315,45 @@ def generate_initial_concatenate_config_by_order(to_be_concatenated_video_info,
     return concatenate_config
 
 
+def sample_concatenation_clip(concatenate_dict, times_in_clip, up_vec):
+    '''
+    concatenate_dict: one of the concatenate dicts with fitted path and orientation
+    times_in_clip: 1D array of times since the start of the concatenation clip
+    return num_frame-by-3 np array of positions and num_frame-by-3-by-3 np array of rotation matrices
+    '''
+    times_in_clip = np.atleast_1d(np.asarray(times_in_clip, dtype=float))
+    path_control_points = concatenate_dict['path_control_points']
+    orientation_control_points = concatenate_dict['orientation_control_points']
+    transition_refs = concatenate_dict['transition_refs']
+
+    # Calculate pos, one batch per bezier curve
+    distances_along_whole_path = get_distances(concatenate_dict['initial_velocities'], concatenate_dict['accels_along_path'], concatenate_dict['travel_times'], times_in_clip)
+    curve_is, ts_along_curve = get_path_curve_indexes_and_ts(path_control_points, concatenate_dict['path_lengths'], distances_along_whole_path)
+    pos = np.empty((len(times_in_clip), 3))
+    path_tangents = None
+    if 'path' in transition_refs:
+        path_tangents = np.empty((len(times_in_clip), 3))
+    for curve_i in np.unique(curve_is):
+        is_on_curve = curve_is == curve_i
+        curve_control_points = np.array(path_control_points[curve_i])
+        pos[is_on_curve] = bezier_batch(curve_control_points, ts_along_curve[is_on_curve])
+        if not path_tangents is None:
+            path_tangents[is_on_curve] = d_bezier_batch(curve_control_points, ts_along_curve[is_on_curve])
+
+    # Calculate orientation, one batch per transition
+    transition_is, ts_along_orientation_curve = get_orientation_transition_indexes_and_ts(concatenate_dict['transition_times'], times_in_clip)
+    rot = np.empty((len(times_in_clip), 3, 3))
+    for transition_i in np.unique(transition_is):
+        frame_indexes = np.flatnonzero(transition_is == transition_i)
+        orientation_curve_control_points = np.array(orientation_control_points[transition_i])
+        rot[frame_indexes] = get_orientation_mats_along_rotation_path(orientation_curve_control_points, ts_along_orientation_curve[frame_indexes])
+        if transition_refs[transition_i] == 'path':
+            for frame_index in frame_indexes:
+                rot[frame_index] = get_path_coord_zero_orientation_mat(path_tangents[frame_index], up_vec) @ rot[frame_index]
+
+    return pos, rot
+
+
 def get_continuously_extracted_frames(frame_names, start_or_end, max_num_frame):
     if start_or_end == 'start':
         start_frame_name_i = 0
@@ -385,54 +426,158 @@ def get_non_nan_chunk_from_list(input_list, num_continuous_non_nan, start_or_end
         return 0, len(input_list)
     
 
+def get_registered_ts(pos, ts):
+    '''
+    pos: n-by-3 positions of all frames, NaN for frames that are not registered
+    ts: timestamps of all frames
+    return the timestamps of the registered frames as a 1D np array, and the timestamp of the last frame
+    which is what start_percent and end_percent are relative to
+    '''
+    pos = np.asarray(pos, dtype=float)
+    ts = np.asarray(ts, dtype=float)
+    return ts[~np.isnan(pos[:,0])], ts[-1]
+
+
+def get_closest_indexes(sorted_values, targets):
+    '''
+    Index of the value closest to each target in the sorted 1D np array, the earlier one on a tie like np.argmin
+    '''
+    right_is = np.clip(np.searchsorted(sorted_values, targets), 1, max(len(sorted_values)-1, 1))
+    if len(sorted_values) == 1:
+        return np.zeros_like(right_is)
+    return np.where(np.abs(targets - sorted_values[right_is-1]) <= np.abs(sorted_values[right_is] - targets), right_is-1, right_is)
+
+
+def get_next_sampled_indexes(ts, frame_is, sampling_interval):
+    '''
+    ts: sorted 1D np array of timestamps
+    frame_is: 1D np array of indexes into ts
+    sampling_interval: sampling interval in the unit of ts, a number or a np array of the same length as frame_is
+    return the index of the frame that is sampled next if frame_is are the last sampled frames, or len(ts) if there is none
+    '''
+    num_ts = len(ts)
+    frame_ts = ts[frame_is]
+
+    # The next frame is sampled because it is sampling_interval (by np.isclose) after the last sampled frame,
+    # and candidates next to the searchsorted one are checked with the exact condition against rounding
+    close_tolerance = 1e-8 + 1e-5 * np.abs(sampling_interval)
+    close_guess_is = np.searchsorted(ts, frame_ts + sampling_interval - close_tolerance)
+    next_close_is = np.full(len(frame_is), num_ts)
+    for offset in (1, 0, -1):
+        candidate_is = np.clip(close_guess_is + offset, 0, num_ts-1)
+        is_close = np.abs((ts[candidate_is] - frame_ts) - sampling_interval) <= close_tolerance
+        next_close_is = np.where(is_close & (candidate_is > frame_is), candidate_is, next_close_is)
+
+    # Or because the frame after it is more than 1.2 times sampling_interval after the last sampled frame
+    too_far_guess_is = np.searchsorted(ts, frame_ts + sampling_interval*1.2, side='right')
+    first_too_far_is = np.full(len(frame_is), num_ts)
+    for offset in (1, 0, -1):
+        candidate_is = np.clip(too_far_guess_is + offset, 0, num_ts-1)
+        is_too_far = ts[candidate_is] - frame_ts > sampling_interval*1.2
+        first_too_far_is = np.where(is_too_far, candidate_is, first_too_far_is)
+    next_too_far_is = np.maximum(first_too_far_is - 1, frame_is + 1)
+
+    return np.minimum(next_close_is, next_too_far_is)
+
+
+def get_sampled_indexes(registered_ts, last_ts, start_percent, end_percent, sampling_interval):
+    '''
+    registered_ts, last_ts: output of get_registered_ts
+    start_percent and end_percent: range selected by trimming
+    sampling_interval: every percent of total video length one sample
+    return the index into registered_ts of the first frame in the range, and the indexes of the sampled frames counted from it
+    Frames are sampled as described at open_project in server.py. All frames are looked at together: for every frame, the frame
+    that would be sampled next if it were the last sampled one is found with searchsorted, then the sampled frames are followed
+    from the start of the range
+    '''
+    start_i, end_i = get_closest_indexes(registered_ts, np.array([start_percent * last_ts, end_percent * last_ts]))
+    ts = registered_ts[start_i:end_i+1] - registered_ts[start_i]
+    sampling_interval = last_ts * sampling_interval
+    num_ts = len(ts)
+    if num_ts == 1:
+        return start_i, np.array([0])
+
+    next_sampled_is = get_next_sampled_indexes(ts, np.arange(num_ts), sampling_interval).tolist()
+    sampled_is = [0]
+    while next_sampled_is[sampled_is[-1]] <= num_ts-2:
+        sampled_is.append(next_sampled_is[sampled_is[-1]])
+    sampled_is.append(num_ts-1)
+    return start_i, np.array(sampled_is)
+
+
+def get_max_stabilization_strength(registered_ts, last_ts, start_percent, end_percent, original_sampling_interval, min_num_sample):
+    '''
+    registered_ts, last_ts: output of get_registered_ts
+    return the largest stabilization strength, at most 10, whose sampling keeps at least min_num_sample frames in the range
+    The strengths are tried from the largest down, each only counting the sampled frames
+    '''
+    stabilization_strength = min(10, int((end_percent - start_percent)/original_sampling_interval/2))
+    while stabilization_strength > 0 and \
+            len(get_sampled_indexes(registered_ts, last_ts, start_percent, end_percent, stabilization_strength*original_sampling_interval)[1]) < min_num_sample:
+        stabilization_strength -= 1
+    return stabilization_strength
+
+
+
+def get_max_stabilization_strength_table(registered_ts, last_ts, trim_percents, original_sampling_interval, min_num_sample):
+    '''
+    registered_ts, last_ts: output of get_registered_ts
+    trim_percents: sorted percents the range can be trimmed at, i.e. sampled_percents of open_project in server.py
+    return a len(trim_percents)-by-10 int np array, where entry [start_i, stabilization_strength-1] is the smallest index end_i into
+    trim_percents such that get_max_stabilization_strength allows stabilization_strength from trim_percents[start_i] to
+    trim_percents[end_i], or -1 if there is no such end_i
+    A longer range never has fewer sampled frames, so each strength is allowed for every end after the smallest one.
+    For every start, the sampled frames of all strengths are followed together until the one that has to be in the range
+    '''
+    trim_percents = np.asarray(trim_percents, dtype=float)
+    num_trim_percent = len(trim_percents)
+    stabilization_strengths = np.arange(1, 11)
+    # Same order of operations as get_sampled_indexes, frames exactly 1.2 times the sampling interval apart are common
+    sampling_intervals = last_ts * (stabilization_strengths * original_sampling_interval)
+    closest_is = get_closest_indexes(registered_ts, trim_percents * last_ts)
+    min_end_is = np.full((num_trim_percent, len(stabilization_strengths)), -1)
+    for start_i in range(num_trim_percent):
+        # The strength is at most half the number of original sampling intervals in the range
+        max_stabilization_strengths = np.minimum(10, ((trim_percents - trim_percents[start_i])/original_sampling_interval/2).astype(int))
+        min_end_is_by_length = np.searchsorted(max_stabilization_strengths, stabilization_strengths)
+
+        # The range has at least min_num_sample sampled frames once the last frame of the range is after the
+        # (min_num_sample-2)th frame sampled after the start, since the last frame of the range is always sampled
+        ts = registered_ts[closest_is[start_i]:] - registered_ts[closest_is[start_i]]
+        sampled_is = np.zeros(len(stabilization_strengths), dtype=int)
+        for _ in range(min_num_sample-2):
+            sampled_is = get_next_sampled_indexes(ts, np.minimum(sampled_is, len(ts)-1), sampling_intervals)
+        min_end_is_by_num_sample = np.searchsorted(closest_is - closest_is[start_i], sampled_is + (min_num_sample > 1))
+
+        cur_min_end_is = np.maximum(min_end_is_by_length, min_end_is_by_num_sample)
+        min_end_is[start_i] = np.where(cur_min_end_is < num_trim_percent, cur_min_end_is, -1)
+    return min_end_is
+
+
+def look_up_max_stabilization_strength(max_stabilization_strength_table, start_i, end_i):
+    '''
+    max_stabilization_strength_table: output of get_max_stabilization_strength_table
+    start_i and end_i: indexes of the trimming range into the trim_percents of the table
+    return the same as get_max_stabilization_strength for the range
+    '''
+    min_end_is = np.asarray(max_stabilization_strength_table[start_i])
+    allowed_stabilization_strengths = np.flatnonzero((min_end_is >= 0) & (min_end_is <= end_i)) + 1
+    if len(allowed_stabilization_strengths) == 0:
+        return 0
+    return int(allowed_stabilization_strengths[-1])
+
 def sample_points(pos, rot, ts, start_percent, end_percent, sampling_interval):
-    # Copy inputs
-    pos_copy = np.copy(pos)
-    rot_copy = np.copy(rot)
-    ts_copy = np.copy(ts)
-
-    # Calculate selected range
-    start_ts = start_percent * ts_copy[-1]
-    end_ts = end_percent * ts_copy[-1]
-    sampling_interval = ts_copy[-1] * sampling_interval
-
-    # Remove NaN
-    included_idx = ~np.isnan(pos_copy[:,0])
-    pos_copy = pos_copy[included_idx, :]
-    rot_copy = rot_copy[included_idx, :]
-    ts_copy = ts_copy[included_idx]
-
-    # Remove the trimmed out part
-    start_i = np.argmin(np.abs(ts_copy-start_ts))
-    end_i = np.argmin(np.abs(ts_copy-end_ts))
-    pos_copy = pos_copy[start_i:end_i+1, :]
-    rot_copy = rot_copy[start_i:end_i+1, :]
-    ts_copy = ts_copy[start_i:end_i+1]
-    ts_copy = ts_copy - ts_copy[0]
-
-    # Sample according sampling_interval
-    sampled_i = []
-    for sampled_frame_i in range(np.size(ts_copy)-1):
-        cur_ts = ts_copy[sampled_frame_i]
-        next_ts = ts_copy[sampled_frame_i+1]
-
-        # Fill the first one
-        if len(sampled_i)==0:
-            sampled_i.append(sampled_frame_i)
-            continue
-
-        # Reach next sample or skipping this make sampling interval too large
-        if np.isclose(cur_ts-ts_copy[sampled_i[-1]], sampling_interval) or \
-                (next_ts-ts_copy[sampled_i[-1]] > sampling_interval*1.2):
-            sampled_i.append(sampled_frame_i)
-    sampled_i.append(np.size(ts_copy)-1)
-    sampled_i = np.array(sampled_i)
-
-    pos_copy = pos_copy[sampled_i]
-    rot_copy = rot_copy[sampled_i]
-    ts_copy = ts_copy[sampled_i]
-
-    return pos_copy, rot_copy, ts_copy
+    pos = np.asarray(pos, dtype=float)
+    rot = np.asarray(rot, dtype=float)
+    ts = np.asarray(ts, dtype=float)
+
+    # Remove NaN, then sample the selected range
+    included_idx = ~np.isnan(pos[:,0])
+    registered_ts = ts[included_idx]
+    start_i, sampled_i = get_sampled_indexes(registered_ts, ts[-1], start_percent, end_percent, sampling_interval)
+    registered_i = np.flatnonzero(included_idx)[start_i + sampled_i]
+
+    return pos[registered_i], rot[registered_i], ts[registered_i] - registered_ts[start_i]
 
 
 def get_frame_name(prefix, video_name, frame_index, file_extension):
@@ -1,7 +1,7 @@
 import numpy as np
-from scipy.optimize import fsolve as solve
+from scipy.linalg import solve_banded
 
-from bezier_curve import d_bezier_coeff, dd_bezier_coeff, bezier_arc_length, t
+from bezier_curve import d_bezier_coeff, dd_bezier_coeff, bezier_arc_length, t, get_arc_length_index
 
 # Helper function to calculate default control points of the path
 def calc_default_path_and_velocity(concatenate_dict, time_between_frames):
@@ -112,20 +112,72 @@ def get_distance(initial_velocities, accels_along_path, travel_times, total_time
         total_distance += initial_velocities[travel_time_i] * cur_travel_time + 1/2 * accels_along_path[travel_time_i] * cur_travel_time**2
         total_time -= cur_travel_time
 
-def fit_speed(last_velocity, next_velocity, path_total_length, time_between_frames):
-    def speed_equation(x):
-        '''
-        x[0] accel, x[1] time
-        '''
-        return [last_velocity * x[1] + 1/2 * x[0] * x[1]**2 - path_total_length, last_velocity + x[0] * x[1] - next_velocity]
-    
-    accel_along_path, travel_time = solve(speed_equation, [1,1])
+def get_path_curve_indexes_and_ts(path_control_points, path_lengths, total_distances):
+    '''
+    Array version of get_path_control_points_and_t
+    total_distances should be a 1D array of distances along the whole path
+    return the index of the curve each distance falls on and the t along that curve, both 1D arrays
+    '''
+    total_distances = np.atleast_1d(np.asarray(total_distances, dtype=float))
+    if np.any(total_distances > np.sum(path_lengths)):
+        raise ValueError("Total distance traveled is longer than the provided path.")
+
+    # A distance equal to the end of a curve still belongs to that curve, as in get_path_control_points_and_t
+    curve_end_distances = np.cumsum(path_lengths)
+    curve_is = np.clip(np.searchsorted(curve_end_distances, total_distances, side='left'), 0, len(path_lengths)-1)
+    distances_along_curve = total_distances - (curve_end_distances - np.asarray(path_lengths))[curve_is]
+
+    ts = np.empty(len(total_distances))
+    for curve_i in np.unique(curve_is):
+        is_on_curve = curve_is == curve_i
+        arc_length_index = get_arc_length_index(np.array(path_control_points[curve_i]))
+        ts[is_on_curve] = arc_length_index.t_and_length(distances_along_curve[is_on_curve])[0]
+    return curve_is, ts
+
+def get_distances(initial_velocities, accels_along_path, travel_times, total_times):
+    '''
+    Array version of get_distance
+    total_times should be a 1D array of times since the start of the path
+    '''
+    total_times = np.atleast_1d(np.asarray(total_times, dtype=float))
+    if np.any(total_times > np.sum(travel_times)):
+        raise ValueError("Total time to travel along the path is longer than the sum of travel_times.")
+
+    initial_velocities = np.asarray(initial_velocities, dtype=float)
+    accels_along_path = np.asarray(accels_along_path, dtype=float)
+    travel_times = np.asarray(travel_times, dtype=float)
+
+    # A time equal to the end of a segment belongs to the next segment, as in get_distance
+    segment_end_times = np.cumsum(travel_times)
+    segment_is = np.clip(np.searchsorted(segment_end_times, total_times, side='right'), 0, len(travel_times)-1)
+    segment_lengths = initial_velocities * travel_times + 1/2 * accels_along_path * travel_times**2
+    segment_start_distances = np.cumsum(segment_lengths) - segment_lengths
+    time_in_segment = total_times - (segment_end_times - travel_times)[segment_is]
+    return segment_start_distances[segment_is] + initial_velocities[segment_is] * time_in_segment + 1/2 * accels_along_path[segment_is] * time_in_segment**2
 
-    # Adjust travel_time and accel_along_path to stay consistent with frame rates
-    travel_time = np.round(travel_time/time_between_frames)*time_between_frames
+def fit_speed(last_velocity, next_velocity, path_total_length, time_between_frames):
+    '''
+    Solve path_total_length = last_velocity * travel_time + 1/2 * accel * travel_time**2 and
+    next_velocity = last_velocity + accel * travel_time, which gives
+    travel_time = 2 * path_total_length / (last_velocity + next_velocity)
+    The velocities and path_total_length can be scalars or arrays that broadcast together, so
+    many transitions can be sized in one call.
+    If last_velocity + next_velocity is 0, a path of length 0 takes one frame and a longer path
+    can never be finished, so its travel_time and accel_along_path are np.nan.
+    '''
+    last_velocity, next_velocity, path_total_length = np.broadcast_arrays(np.asarray(last_velocity, dtype=float), \
+                                                                          np.asarray(next_velocity, dtype=float), \
+                                                                          np.asarray(path_total_length, dtype=float))
+    velocity_sum = last_velocity + next_velocity
+    is_velocity_sum_zero = np.isclose(velocity_sum, 0)
+    travel_time = np.divide(2 * path_total_length, velocity_sum, out=np.full(velocity_sum.shape, np.nan), where=~is_velocity_sum_zero)
+    travel_time[is_velocity_sum_zero & np.isclose(path_total_length, 0)] = 0
+
+    # Adjust travel_time and accel_along_path to stay consistent with frame rates, using at least one frame
+    travel_time = np.maximum(np.round(travel_time/time_between_frames), 1) * time_between_frames
     accel_along_path = 2 * (path_total_length - last_velocity * travel_time) / travel_time**2
 
-    return last_velocity, accel_along_path, travel_time
+    return last_velocity[()], accel_along_path[()], travel_time[()]
 
 def fit_path(initial_pos, initial_first_order_d, initial_second_order_d, final_pos, final_first_order_d, final_second_order_d, intermediate_pos):
     '''
@@ -193,62 +245,62 @@ def fit_path(initial_pos, initial_first_order_d, initial_second_order_d, final_p
                 np.vstack((intermediate_pos[0,:], middle_control_points[3:,:], final_pos))]
     
     # One 4-th order bezier curve, num_intermediate_pos-1 3-rd order bezier curves, one 4-th order bezier curve if num_intermediate_pos > 1
+    # A is banded with 2 sub-diagonals and 3 super-diagonals, so only its band is stored in the
+    # (2+3+1)-by-num_unknown layout of scipy.linalg.solve_banded, where A[i,j] is A_band[3+i-j, j]
     else:
         control_points_place_holder_5 = np.zeros((5,num_dimension))
         num_key_pos = np.size(intermediate_pos, 0) + 2
         num_curve = num_key_pos - 1
-        A = np.zeros((2*num_key_pos, 2*num_key_pos))
-        b = np.zeros((2*num_key_pos, num_dimension))
-        for cur_curve_i in range(num_curve-1):
-            # here, the index of curves start with 0
-
-            # at cur_curve_i = 0, we set up initial condition and continuation with curve 1
-            if cur_curve_i == 0:
-
-                # initial condition
-                d_0 = d_bezier_coeff(control_points_place_holder_5, 0)
-                dd_0 = dd_bezier_coeff(control_points_place_holder_5, 0)
-                A[0, 0:len(d_0)-1] = d_0[1:]
-                b[0,:] = initial_first_order_d - d_0[0] * initial_pos
-                A[1, 0:len(dd_0)-1] = dd_0[1:]
-                b[1,:] = initial_second_order_d - dd_0[0] * initial_pos
-
-                # continuation with curve 1
-                A[2,2:4] = [4,3]
-                b[2,:] = 7*intermediate_pos[0,:]
-                A[3, 1:5] = [2, -4, 2, -1]
-                b[3,:] = -intermediate_pos[0,:]
-
-
-            # at cur_curve_i = num_curve-2, we set up continuation between curve num_curve-2 and num_curve-1
-            # we also set up the final condition for curve num_curve-1
-            elif cur_curve_i == num_curve-2:
-
-                # continuation between num_curve-2 and num_curve-1
-                A[-4, -5:] = [0, 3, 4, 0, 0]
-                b[-4,:] = 7*intermediate_pos[-1,:]
-                A[-3, -5:] = [1, -2, 4, -2, 0]
-                b[-3,:] = intermediate_pos[-1,:]
-
-                # final condition
-                d_1 = d_bezier_coeff(control_points_place_holder_5, 1)
-                dd_1 = dd_bezier_coeff(control_points_place_holder_5, 1)
-                A[-2, -3:] = d_1[1:-1]
-                b[-2,:] =  final_first_order_d - d_1[-1] * final_pos
-                A[-1, -3:] = dd_1[1:-1]
-                b[-1,:] =  final_second_order_d - dd_1[-1] * final_pos
-
-
-            # at cur_curve_i = i where 0<i<num_curve-2, we set up continuation between curve i and curve i+1
-            # for each curve, we have two continuation conditions, we also have two equations for initial condition, so 2*cur_curve_i + 2
-            # for each curve, we have two unknown control points, but the first one has three, so 2*curve_i + 1
-            else:
-                A[2*cur_curve_i+2, 2*cur_curve_i+1:2*cur_curve_i+1+4] = [0, 1, 1, 0]
-                b[2*cur_curve_i+2,:] = 2*intermediate_pos[cur_curve_i,:]
-                A[2*cur_curve_i+2+1, 2*cur_curve_i+1:2*cur_curve_i+1+4] = [1,-2, 2, -1]
-                b[2*cur_curve_i+2+1,:] = [0] * num_dimension
+        num_unknown = 2*num_key_pos
+        num_sub_diagonal, num_super_diagonal = 2, 3
+        A_band = np.zeros((num_sub_diagonal+num_super_diagonal+1, num_unknown))
+        b = np.zeros((num_unknown, num_dimension))
+
+        def set_A(rows, first_col, values):
+            '''
+            Equivalent of A[rows, first_col:first_col+len(values)] = values, rows and first_col can be matching 1D arrays
+            '''
+            rows = np.atleast_1d(rows)[:, None]
+            cols = np.atleast_1d(first_col)[:, None] + np.arange(len(values))[None, :]
+            A_band[num_super_diagonal + rows - cols, cols] = values
+
+        # initial condition
+        d_0 = d_bezier_coeff(control_points_place_holder_5, 0)
+        dd_0 = dd_bezier_coeff(control_points_place_holder_5, 0)
+        set_A(0, 0, d_0[1:])
+        b[0,:] = initial_first_order_d - d_0[0] * initial_pos
+        set_A(1, 0, dd_0[1:])
+        b[1,:] = initial_second_order_d - dd_0[0] * initial_pos
 
-        middle_control_points = np.linalg.inv(A) @ b
+        # continuation between curve 0 and curve 1
+        set_A(2, 2, [4,3])
+        b[2,:] = 7*intermediate_pos[0,:]
+        set_A(3, 1, [2, -4, 2, -1])
+        b[3,:] = -intermediate_pos[0,:]
+
+        # continuation between curve i and curve i+1 where 0<i<num_curve-2
+        # for each curve, we have two continuation conditions, we also have two equations for initial condition, so 2*cur_curve_i + 2
+        # for each curve, we have two unknown control points, but the first one has three, so 2*curve_i + 1
+        cur_curve_is = np.arange(1, num_curve-2)
+        set_A(2*cur_curve_is+2, 2*cur_curve_is+1, [0, 1, 1, 0])
+        b[2*cur_curve_is+2,:] = 2*intermediate_pos[cur_curve_is,:]
+        set_A(2*cur_curve_is+3, 2*cur_curve_is+1, [1,-2, 2, -1])
+
+        # continuation between num_curve-2 and num_curve-1
+        set_A(num_unknown-4, num_unknown-5, [0, 3, 4, 0, 0])
+        b[-4,:] = 7*intermediate_pos[-1,:]
+        set_A(num_unknown-3, num_unknown-5, [1, -2, 4, -2, 0])
+        b[-3,:] = intermediate_pos[-1,:]
+
+        # final condition
+        d_1 = d_bezier_coeff(control_points_place_holder_5, 1)
+        dd_1 = dd_bezier_coeff(control_points_place_holder_5, 1)
+        set_A(num_unknown-2, num_unknown-3, d_1[1:-1])
+        b[-2,:] =  final_first_order_d - d_1[-1] * final_pos
+        set_A(num_unknown-1, num_unknown-3, dd_1[1:-1])
+        b[-1,:] =  final_second_order_d - dd_1[-1] * final_pos
+
+        middle_control_points = solve_banded((num_sub_diagonal, num_super_diagonal), A_band, b)
 
         control_points = []
         for curve_i in range(num_curve):
@@ -260,4 +312,4 @@ def fit_path(initial_pos, initial_first_order_d, initial_second_order_d, final_p
                 control_points.append(np.vstack((intermediate_pos[curve_i-1,:], middle_control_points[2*curve_i+1:2*curve_i+1+2], \
                                                      intermediate_pos[curve_i,:])))
                 
-        return control_points
\ No newline at end of file
+        return control_points
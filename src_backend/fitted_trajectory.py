@@ -0,0 +1,349 @@
+from scipy.spatial.transform import Rotation
+import numpy as np
+from scipy.interpolate import BSpline
+
+from orientation_quaternion import rotation_order
+from quaternion_operations import quat_angular_dist, rot_to_quat, quat_multiply, quat_conjugate, quat_log, quat_make_continuous, quat_bspline, quat_bspline_angular_speed, dot, quat_bspline_angular_velocity
+from bezier_curve import gauss_legendre_nodes, gauss_legendre_weights
+from concatenate_utils import sample_points
+
+class Fitted_Trajectory:
+    def __init__(self, pos, rot, ts, start_percent, end_percent, sampling_interval):
+        '''
+        pos: n-by-3 np array
+        rot: n-by-3 euler angle given in rotation_order
+        ts: timestamp of each row given in a 1D numpy array
+        start_percent and end_percent: range selected by trimming
+        sampling_interval: every percent of total video length one sample
+        The position B-spline, the rotation B-spline and their arc length lookup tables are fitted once here
+        and shared by every stage that stabilizes the same range with the same sampling interval
+        '''
+        # Store input to potentially reuse current fitting result
+        self.selected_range = (start_percent, end_percent)
+        self.sampling_interval = sampling_interval
+
+        pos, rot, ts = sample_points(pos, rot, ts, start_percent, end_percent, sampling_interval)
+
+        if np.size(pos, 0) < 4:
+            raise ValueError("The number of points provided is less than 4. There must be at least 4 points.")
+        self.pos = pos
+        self.ts = ts
+
+
+        # Interpolate the positions to get the stabilized path
+        # Construct the clamped cubic (degree=3, order=4) B spline knots array
+        num_points_to_interpolate = np.size(self.ts)
+        knots = [x/(num_points_to_interpolate-1) for x in range(num_points_to_interpolate-1)]
+        knots[1] = 0.0
+        knots[-1] = 1.0
+        knots = [0.0,0.0] + knots + [1.0,1.0,1.0]
+        # Then construct the B-spline representing the path
+        self.path_bspline = BSpline(knots, self.pos, 3)
+        self.path_bspline_derivative = self.path_bspline.derivative()
+
+        # Calculate the stabilized speed along the path
+        # Figure out the t and distance that corresponds to each sampled position
+        t_corresponding_to_pos = self.__closest_ts_on_path(self.pos)
+            
+        # Calculate the distance on spline between each consecutive pair of t's
+        # and fill the lookup table of (distance along path, t, position), which is sorted by both distance and t
+        path_lookup_table_chunks = [(np.array([0.0]), np.array([0.0]), self.pos[0:1,:])]
+        distances_of_timestamped_pos_from_start = [0.0]
+        for pos_i in range(np.size(self.pos, 0)-1):
+            distances_of_timestamped_pos_from_start.append(\
+                distances_of_timestamped_pos_from_start[-1]\
+                      + self.__bspline_arc_length(t_corresponding_to_pos[pos_i], t_corresponding_to_pos[pos_i+1],\
+                                                  lookup_table_chunks=path_lookup_table_chunks, \
+                                                  t_start_distance=distances_of_timestamped_pos_from_start[-1]))
+        path_lookup_table_chunks.append((np.array([distances_of_timestamped_pos_from_start[-1]]), np.array([1.0]), self.pos[-1:,:]))
+        self.path_lookup_distances, self.path_lookup_ts, self.path_lookup_pos = \
+            [np.concatenate(column) for column in zip(*path_lookup_table_chunks)]
+        self.path_total_length = distances_of_timestamped_pos_from_start[-1]
+        self.distances_of_timestamped_pos_from_start = distances_of_timestamped_pos_from_start
+
+
+
+        # Calculate the stabilized orientation
+        # The quaternion B-spline uses cumulative basis on the same knots as the path, refer to
+        # http://graphics.cs.cmu.edu/nsp/course/15-464/Fall05/papers/kimKimShin.pdf for more detail
+        self.bspline_knots = np.array(knots)
+        
+        # Get the quaternions used to form the B-spline. Here, we make sure they are represented in a way such that each pair of
+        # the quaternions are along the shortest arc
+        self.interpolated_rot_quats = quat_make_continuous(rot_to_quat(Rotation.from_euler(rotation_order, rot)))
+        self.omegas_for_bspline = np.concatenate((self.interpolated_rot_quats[0:1], \
+                                                  quat_log(quat_multiply(quat_conjugate(self.interpolated_rot_quats[:-1]), self.interpolated_rot_quats[1:]))))
+
+        # Figure out the t and distance that corresponds to each sampled orientation
+        t_corresponding_to_rot = self.__closest_ts_on_rot_path(self.interpolated_rot_quats)
+            
+        # Calculate the distance on spline between each consecutive pair of t's
+        # and fill the lookup table of (angular distance along rotation path, t, quaternion), which is sorted by both distance and t
+        rot_lookup_table_chunks = [(np.array([0.0]), np.array([0.0]), self.interpolated_rot_quats[0:1])]
+        distances_of_timestamped_rot_from_start = [0.0]
+        for rot_i in range(len(self.interpolated_rot_quats)-1):
+            distances_of_timestamped_rot_from_start.append(\
+                distances_of_timestamped_rot_from_start[-1]\
+                      + self.__quat_bspline_arc_length(t_corresponding_to_rot[rot_i], t_corresponding_to_rot[rot_i+1],\
+                                                       lookup_table_chunks=rot_lookup_table_chunks,\
+                                                       t_start_distance=distances_of_timestamped_rot_from_start[-1]))
+        rot_lookup_table_chunks.append((np.array([distances_of_timestamped_rot_from_start[-1]]), np.array([1.0]), self.interpolated_rot_quats[-1:]))
+        self.rot_lookup_angular_distances, self.rot_lookup_ts, self.rot_lookup_quats = \
+            [np.concatenate(column) for column in zip(*rot_lookup_table_chunks)]
+        self.rot_path_total_angular_distance = distances_of_timestamped_rot_from_start[-1]
+        self.distances_of_timestamped_rot_from_start = distances_of_timestamped_rot_from_start
+
+
+
+    # Attributes written by get_snapshot and restored by from_snapshot, everything else is rebuilt from them
+    snapshot_array_names = ['pos', 'ts', 'bspline_knots', 'path_lookup_distances', 'path_lookup_ts', 'path_lookup_pos', \
+                            'interpolated_rot_quats', 'omegas_for_bspline', 'rot_lookup_angular_distances', 'rot_lookup_ts', 'rot_lookup_quats']
+    snapshot_list_names = ['distances_of_timestamped_pos_from_start', 'distances_of_timestamped_rot_from_start']
+    snapshot_scalar_names = ['sampling_interval', 'path_total_length', 'rot_path_total_angular_distance']
+
+
+    def get_snapshot(self):
+        '''
+        return a dict of np arrays holding everything that is fitted, which from_snapshot turns back into a Fitted_Trajectory
+        '''
+        snapshot = {name: np.asarray(getattr(self, name)) for name in self.snapshot_array_names + self.snapshot_list_names + self.snapshot_scalar_names}
+        snapshot['selected_range'] = np.array(self.selected_range)
+        return snapshot
+
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        '''
+        snapshot: dict of np arrays returned by get_snapshot
+        return the Fitted_Trajectory without fitting anything again
+        '''
+        fitted_trajectory = cls.__new__(cls)
+        for name in cls.snapshot_array_names:
+            setattr(fitted_trajectory, name, np.array(snapshot[name]))
+        for name in cls.snapshot_list_names:
+            setattr(fitted_trajectory, name, snapshot[name].tolist())
+        for name in cls.snapshot_scalar_names:
+            setattr(fitted_trajectory, name, snapshot[name].item())
+        fitted_trajectory.selected_range = tuple(snapshot['selected_range'].tolist())
+        fitted_trajectory.path_bspline = BSpline(fitted_trajectory.bspline_knots, fitted_trajectory.pos, 3)
+        fitted_trajectory.path_bspline_derivative = fitted_trajectory.path_bspline.derivative()
+        return fitted_trajectory
+
+
+    def get_fitting_params(self):
+        return self.selected_range, self.sampling_interval
+
+
+    def get_original_ts_to_distance_dense_mapping(self):
+        return self.ts, self.distances_of_timestamped_pos_from_start, self.distances_of_timestamped_rot_from_start
+
+
+
+    def __bspline_arc_length(self, t_start, t_end, length_change_threshold_percent = 0.001, \
+                             initial_num_t_step_for_whole_curve = 1000, lookup_table_chunks=None,\
+                             t_start_distance = -np.inf):
+        '''
+        Iteratively slice the curve into smaller and smaller parts to calculate curve length
+        until the length change between two iterations is below a percent threshold
+        bspline is a scipy.interpolate.BSpline object
+        t_start and t_end between 0 and 1, t_end>t_start
+        lookup_table_chunks: if given, the (distance, t, position) arrays of the finest slicing are appended to it
+        '''
+        length_change_percent = np.inf
+        cur_num_t_step = max((int(initial_num_t_step_for_whole_curve * (t_end-t_start)), 10))
+        last_length = -np.inf
+        for i in range(4):
+            if length_change_percent <= length_change_threshold_percent:
+                break
+            # Evaluate the whole slicing at once and accumulate the chord lengths
+            cur_ts = np.arange(1, cur_num_t_step+1) / cur_num_t_step * (t_end - t_start) + t_start
+            positions = self.path_bspline(np.concatenate(([t_start], cur_ts)))
+            cumulative_lengths = np.cumsum(np.linalg.norm(positions[1:] - positions[:-1], axis=1))
+            total_length = cumulative_lengths[-1]
+            if i==0:
+                length_change_percent = np.inf
+            else:
+                length_change_percent = (total_length - last_length) / last_length
+            # print(cur_num_t_step, last_length, total_length, length_change)
+            last_length = total_length
+            cur_num_t_step = cur_num_t_step * 2
+            if i>0 and not lookup_table_chunks is None:
+                finest_lookup_entries = (cumulative_lengths+t_start_distance, cur_ts, positions[1:])
+
+        if not lookup_table_chunks is None:
+            lookup_table_chunks.append(finest_lookup_entries)
+        return last_length
+
+
+    def quat_along_rot_bspline(self, t):
+        '''
+        Calculate the quaternion at the given t, which is between 0 and 1
+        t can also be a 1D array, in which case a len(t)-by-4 array is returned
+        '''
+        quats = quat_bspline(self.interpolated_rot_quats, self.omegas_for_bspline, self.bspline_knots, np.atleast_1d(np.asarray(t, dtype=float)))
+        if np.ndim(t) == 0:
+            return quats[0]
+        return quats
+    
+
+    def __quat_bspline_arc_length(self, t_start, t_end,\
+                                  length_change_threshold_percent = 0.0005, \
+                                  initial_num_t_step_for_whole_curve=1000,\
+                                  lookup_table_chunks = None, \
+                                  t_start_distance = -np.inf):
+        '''
+        Calculate the total angular distance of the given quaternion B-spline
+        lookup_table_chunks: if given, the (angular distance, t, quaternion) arrays of the finest slicing are appended to it
+        '''
+        length_change_percent = np.inf
+        cur_num_t_step = max((int(initial_num_t_step_for_whole_curve * (t_end-t_start)),10))
+        last_length = -np.inf
+        for i in range(5):
+            if length_change_percent <= length_change_threshold_percent:
+                break
+            cur_ts = np.arange(1, cur_num_t_step+1) / cur_num_t_step * (t_end - t_start) + t_start
+            quats = self.quat_along_rot_bspline(np.concatenate(([t_start], cur_ts)))
+            cumulative_lengths = np.cumsum(quat_angular_dist(quats[:-1], quats[1:]))
+            total_length = cumulative_lengths[-1]
+            if i==0:
+                length_change_percent = np.inf
+            else:
+                length_change_percent = (total_length - last_length) / last_length
+            # print(cur_num_t_step, last_length, total_length, length_change)
+            last_length = total_length
+            cur_num_t_step = cur_num_t_step * 2
+            if i>0 and not lookup_table_chunks is None:
+                finest_lookup_entries = (cumulative_lengths+t_start_distance, cur_ts, quats[1:])
+
+        if not lookup_table_chunks is None:
+            lookup_table_chunks.append(finest_lookup_entries)
+        return last_length
+
+
+    def __path_speed(self, ts):
+        return np.linalg.norm(self.path_bspline_derivative(ts), axis=-1)
+
+
+    def __rot_path_angular_speed(self, ts):
+        return quat_bspline_angular_speed(self.interpolated_rot_quats, self.omegas_for_bspline, self.bspline_knots, ts)
+
+
+    def __t_given_arc_length(self, s, lookup_distances, lookup_ts, speed_along_t, length_err_threshold, max_num_newton_iteration):
+        '''
+        Calculates the t that travels along a curve by distance s, s can be a scalar or a 1D array
+        Start from linear interpolation inside the lookup table cell containing s and take safeguarded Newton steps.
+        The length from the cell start to t is integrated from speed_along_t with Gauss-Legendre quadrature,
+        and steps that leave the bracket of the solution fall back to bisection
+        return t, actual length along curve, length error
+        '''
+        distances = np.atleast_1d(np.asarray(s, dtype=float))
+        cell_is = np.clip(np.searchsorted(lookup_distances, distances, side='right') - 1, 0, len(lookup_distances)-2)
+        cell_start_ts = lookup_ts[cell_is]
+        cell_start_distances = lookup_distances[cell_is]
+        t_lower_bounds = cell_start_ts
+        t_upper_bounds = lookup_ts[cell_is+1]
+        cell_lengths = lookup_distances[cell_is+1] - cell_start_distances
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cell_percents = np.clip(np.where(cell_lengths > 0, (distances - cell_start_distances) / cell_lengths, 0.0), 0.0, 1.0)
+        ts = cell_start_ts + (t_upper_bounds - cell_start_ts) * cell_percents
+
+        def length_at(ts):
+            quadrature_ts = cell_start_ts[:, None] + (ts - cell_start_ts)[:, None] * gauss_legendre_nodes
+            return cell_start_distances + (ts - cell_start_ts) * (speed_along_t(quadrature_ts.ravel()).reshape(quadrature_ts.shape) @ gauss_legendre_weights)
+
+        for i in range(max_num_newton_iteration):
+            length_errs = length_at(ts) - distances
+            is_converged = np.abs(length_errs) <= length_err_threshold
+            if np.all(is_converged):
+                break
+            t_lower_bounds = np.where(length_errs < 0, ts, t_lower_bounds)
+            t_upper_bounds = np.where(length_errs > 0, ts, t_upper_bounds)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                newton_ts = ts - length_errs / speed_along_t(ts)
+            is_in_bracket = (newton_ts > t_lower_bounds) & (newton_ts < t_upper_bounds)
+            ts = np.where(is_converged, ts, np.where(is_in_bracket, newton_ts, (t_lower_bounds + t_upper_bounds) / 2))
+        lengths = length_at(ts)
+
+        if np.ndim(s) == 0:
+            return ts[0], lengths[0], lengths[0] - distances[0]
+        return ts, lengths, lengths - distances
+
+
+    def t_given_distance(self, s, length_err_threshold_percent = 1e-6, max_num_newton_iteration = 10):
+        '''
+        Calculates the t between 0 and 1 that travels along the curve by distance s, s can be a scalar or a 1D array
+        return t, actual length along curve, length error
+        '''
+        if np.any(np.asarray(s) > self.path_total_length):
+            raise ValueError("Input path length is longer than the total length of the path.")
+        return self.__t_given_arc_length(s, self.path_lookup_distances, self.path_lookup_ts, self.__path_speed, \
+                                         self.path_total_length * length_err_threshold_percent, max_num_newton_iteration)
+
+
+    def t_given_angular_distance(self, s, length_err_threshold_percent = 1e-6, max_num_newton_iteration = 10):
+        '''
+        Calculates the t between 0 and 1 that travels along the rotation curve by angular distance s, s can be a scalar or a 1D array
+        return t, actual angular distance along curve, angular distance error
+        '''
+        if np.any(np.asarray(s) > self.rot_path_total_angular_distance):
+            raise ValueError("Input rotation path length is longer than the total length of the rotation path.")
+        return self.__t_given_arc_length(s, self.rot_lookup_angular_distances, self.rot_lookup_ts, self.__rot_path_angular_speed, \
+                                         self.rot_path_total_angular_distance * length_err_threshold_percent, max_num_newton_iteration)
+
+
+    def __closest_ts_on_path(self, sampled_pos, num_points_to_calculate_on_searched_seg = 32, num_newton_iteration = 4):
+        '''
+        Find the t of every interior sampled position, which is where the path is closest to it within half a knot interval
+        of its own knot. All samples are searched on a grid at once and refined by Newton steps on the derivative of the
+        squared distance, a step is only taken if it gets closer
+        return a 1D array of t which starts at 0 and ends at 1
+        '''
+        num_sample = np.size(sampled_pos, 0)
+        target_pos = sampled_pos[1:-1]
+        window_half_width = 0.5/(num_sample-1)
+        window_centers = np.arange(1, num_sample-1) / (num_sample-1)
+        t_of_points_to_consider = window_centers[:, None] + np.linspace(-window_half_width, window_half_width, num_points_to_calculate_on_searched_seg+1)
+        squared_distances_of_points = np.sum((self.path_bspline(t_of_points_to_consider) - target_pos[:, None, :])**2, axis=2)
+        ts = t_of_points_to_consider[np.arange(len(window_centers)), np.argmin(squared_distances_of_points, axis=1)]
+
+        path_bspline_second_derivative = self.path_bspline_derivative.derivative()
+        for i in range(num_newton_iteration):
+            offsets = self.path_bspline(ts) - target_pos
+            first_derivatives = self.path_bspline_derivative(ts)
+            gradients = np.sum(first_derivatives * offsets, axis=1)
+            hessians = np.sum(first_derivatives**2, axis=1) + np.sum(path_bspline_second_derivative(ts) * offsets, axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                newton_ts = np.clip(ts - gradients / hessians, window_centers - window_half_width, window_centers + window_half_width)
+            newton_ts = np.where(hessians > 0, newton_ts, ts)
+            is_closer = np.sum((self.path_bspline(newton_ts) - target_pos)**2, axis=1) <= np.sum(offsets**2, axis=1)
+            ts = np.where(is_closer, newton_ts, ts)
+        return np.concatenate(([0.0], ts, [1.0]))
+
+
+    def __closest_ts_on_rot_path(self, sampled_quats, num_points_to_calculate_on_searched_seg = 32, num_newton_iteration = 4):
+        '''
+        Find the t of every interior sampled quaternion, which is where the rotation path is angularly closest to it within
+        half a knot interval of its own knot. All samples are searched on a grid at once and refined by Gauss-Newton steps
+        on the rotation vector from the sample to the path, a step is only taken if it gets closer
+        return a 1D array of t which starts at 0 and ends at 1
+        '''
+        num_sample = np.size(sampled_quats, 0)
+        target_quats = sampled_quats[1:-1]
+        window_half_width = 0.5/(num_sample-1)
+        window_centers = np.arange(1, num_sample-1) / (num_sample-1)
+        t_of_points_to_consider = window_centers[:, None] + np.linspace(-window_half_width, window_half_width, num_points_to_calculate_on_searched_seg+1)
+        quats_of_points = self.quat_along_rot_bspline(t_of_points_to_consider.ravel()).reshape(t_of_points_to_consider.shape + (4,))
+        ts = t_of_points_to_consider[np.arange(len(window_centers)), np.argmin(quat_angular_dist(quats_of_points, target_quats[:, None, :]), axis=1)]
+
+        for i in range(num_newton_iteration):
+            quats = self.quat_along_rot_bspline(ts)
+            aligned_target_quats = np.where((dot(quats, target_quats) < 0)[:, None], -target_quats, target_quats)
+            residuals = 2 * quat_log(quat_multiply(quat_conjugate(aligned_target_quats), quats))[:, 1:]
+            angular_velocities = quat_bspline_angular_velocity(self.interpolated_rot_quats, self.omegas_for_bspline, self.bspline_knots, ts)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                gauss_newton_ts = np.clip(ts - np.sum(angular_velocities * residuals, axis=1) / np.sum(angular_velocities**2, axis=1), \
+                                          window_centers - window_half_width, window_centers + window_half_width)
+            gauss_newton_ts = np.where(np.isfinite(gauss_newton_ts), gauss_newton_ts, ts)
+            is_closer = quat_angular_dist(self.quat_along_rot_bspline(gauss_newton_ts), target_quats) <= quat_angular_dist(quats, target_quats)
+            ts = np.where(is_closer, gauss_newton_ts, ts)
+        return np.concatenate(([0.0], ts, [1.0]))
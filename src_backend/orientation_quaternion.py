@@ -1,10 +1,9 @@
 import numpy as np
-import quaternion
 from scipy.spatial.transform import Rotation, Slerp
 
-from bezier_curve import d_bezier, bezier_coeff
+from bezier_curve import bezier_coeff_batch
 from fit_path_and_velocity import get_path_control_points_and_t, get_distance
-from quaternion_operations import dot, rot_to_quat
+from quaternion_operations import dot, rot_to_quat, quat_to_rot, quat_multiply, quat_product, quat_conjugate, quat_exp, quat_log
 
 # Z forward, Y down, X right
 rotation_order = 'zxy'
@@ -118,46 +117,74 @@ def get_orientation_control_points_and_t(orientation_control_points, transition_
             return np.array(orientation_control_points[transition_time_i]), total_time/cur_transition_time, transition_refs[transition_time_i]
         total_time -= cur_transition_time
 
+def get_orientation_transition_indexes_and_ts(transition_times, total_times):
+    '''
+    Array version of get_orientation_control_points_and_t
+    total_times should be a 1D array of times since the start of the transition
+    return the index of the transition each time falls on and the t along that transition, both 1D arrays
+    '''
+    total_times = np.atleast_1d(np.asarray(total_times, dtype=float))
+    if np.any(total_times > np.sum(transition_times)):
+        raise ValueError("The provided total time is larger than the sum of transition_times.")
+
+    transition_times = np.asarray(transition_times, dtype=float)
+    transition_end_times = np.cumsum(transition_times)
+    transition_is = np.clip(np.searchsorted(transition_end_times, total_times, side='right'), 0, len(transition_times)-1)
+    ts = (total_times - (transition_end_times - transition_times)[transition_is]) / transition_times[transition_is]
+    return transition_is, ts
+
 def get_orientation_mat_along_rotation_path(rotation_path, t):
     '''
     return a 3-by-3 np array
+    '''
+    return get_orientation_mats_along_rotation_path(rotation_path, [t])[0]
+
+def get_orientation_mats_along_rotation_path(rotation_path, ts):
+    '''
+    ts is a 1D array of t between 0 and 1
+    return a len(ts)-by-3-by-3 np array
     from https://dl.acm.org/doi/pdf/10.1145/218380.218486
     '''
-    basis = bezier_coeff(rotation_path, t)
-    qt = rotation_path[0]
-    for omega_i in range(1, len(rotation_path)):
-        cur_cumulative_basis = np.sum(basis[omega_i:])
-        qt = qt * np.exp(cur_cumulative_basis * rotation_path[omega_i])
+    rotation_path = np.asarray(rotation_path, dtype=float)
+    basis = bezier_coeff_batch(rotation_path, ts)
+    # cumulative_basis[:, i] is the sum of basis[:, i:]
+    cumulative_basis = np.cumsum(basis[:, ::-1], axis=1)[:, ::-1]
+    exp_omegas = quat_exp(cumulative_basis[:, 1:, None] * rotation_path[1:])
+    qt = quat_multiply(rotation_path[0], quat_product(exp_omegas))
     
-    return Rotation.from_quat([qt.x, qt.y, qt.z, qt.w]).as_matrix()
+    return quat_to_rot(qt).as_matrix()
 
 
 def get_rotation_path(initial_quat, initial_angular_velocity, initial_angular_accel, final_quat, final_angular_velocity, final_angular_accel, travel_time):
     '''
-    initial_quat and final_quat should be np.quaternion
+    initial_quat and final_quat should be 4-element np array in w, x, y, z order
     initial_angular_velocity and final_angular_velocity should be 3-element np array showing angular velocity in radians/sec
     initial_angular_accel and final_angular_accel should be 3-element np array showing angular velocity in radians/sec^2
-    rotation path represented by 6 quaternions, which are q0, omega1, omega2, omega3, omega4, and omega5
+    rotation path represented by a 6-by-4 np array of quaternions, which are q0, omega1, omega2, omega3, omega4, and omega5
+    All quaternions here are unit quaternions, so their inverse is their conjugate
     '''
+    initial_quat = np.asarray(initial_quat, dtype=float)
+    final_quat = np.asarray(final_quat, dtype=float)
     if dot(initial_quat, final_quat) < 0:
         final_quat = -final_quat
 
-    omega_start = np.quaternion(0, *(initial_angular_velocity * travel_time))
-    omega_end = np.quaternion(0, *(final_angular_velocity * travel_time))
-    alpha_start = np.quaternion(0, *(initial_angular_accel * travel_time * travel_time))
-    alpha_end = np.quaternion(0, *(final_angular_accel * travel_time * travel_time))
+    omega_start = np.concatenate(([0.0], initial_angular_velocity * travel_time))
+    omega_end = np.concatenate(([0.0], final_angular_velocity * travel_time))
+    alpha_start = np.concatenate(([0.0], initial_angular_accel * travel_time * travel_time))
+    alpha_end = np.concatenate(([0.0], final_angular_accel * travel_time * travel_time))
     q0 = initial_quat
     q5 = final_quat
-    q1 = q0 * np.exp(omega_start/10)
-    q4 = q5 * np.exp(omega_end/10).inverse()
-    omega_1 = np.log(q0.inverse()*q1)
-    omega_5 = np.log(q4.inverse()*q5)
-    q2 = q1 * np.exp(alpha_start/40+omega_1)
-    q3 = q4 * np.exp(q4.inverse()*q5*(omega_5 - alpha_end/40)*q5.inverse()*q4).inverse()
+    q1 = quat_multiply(q0, quat_exp(omega_start/10))
+    q4 = quat_multiply(q5, quat_conjugate(quat_exp(omega_end/10)))
+    omega_1 = quat_log(quat_multiply(quat_conjugate(q0), q1))
+    omega_5 = quat_log(quat_multiply(quat_conjugate(q4), q5))
+    q2 = quat_multiply(q1, quat_exp(alpha_start/40+omega_1))
+    q4_inv_q5 = quat_multiply(quat_conjugate(q4), q5)
+    q3 = quat_multiply(q4, quat_conjugate(quat_exp(quat_multiply(quat_multiply(q4_inv_q5, omega_5 - alpha_end/40), quat_conjugate(q4_inv_q5)))))
     
-    omega_2 = np.log(q1.inverse() * q2)
-    omega_3 = np.log(q2.inverse() * q3)
-    omega_4 = np.log(q3.inverse() * q4)
+    omega_2 = quat_log(quat_multiply(quat_conjugate(q1), q2))
+    omega_3 = quat_log(quat_multiply(quat_conjugate(q2), q3))
+    omega_4 = quat_log(quat_multiply(quat_conjugate(q3), q4))
 
     return np.array([q0, omega_1, omega_2, omega_3, omega_4, omega_5])
 
@@ -1,12 +1,187 @@
 import numpy as np
-import quaternion
+from scipy.spatial.transform import Rotation
+
+# Quaternions are stored as ...-by-4 float arrays in w, x, y, z order, and every function
+# broadcasts over the leading dimensions, so a single quaternion is just a 4-element array.
+identity_quat = np.array([1.0, 0.0, 0.0, 0.0])
 
 
 def dot(q1, q2):
-    return q1.w*q2.w + q1.x*q2.x + q1.y*q2.y + q1.z*q2.z
+    return np.sum(np.asarray(q1, dtype=float) * np.asarray(q2, dtype=float), axis=-1)
 
 def quat_angular_dist(q1, q2):
-    return 2*np.arccos(np.clip(np.abs((q1*np.conjugate(q2)).w), 0.0, 1.0))
+    # The w of q1*conjugate(q2) is the 4D dot product of q1 and q2
+    return 2*np.arccos(np.clip(np.abs(dot(q1, q2)), 0.0, 1.0))
 
 def rot_to_quat(r):
-    return np.quaternion(*(r.as_quat(canonical=True)[[3,0,1,2]]))
\ No newline at end of file
+    '''
+    r is a scipy Rotation holding one or many rotations
+    return a 4-element (or n-by-4) array in w, x, y, z order with w >= 0
+    '''
+    return r.as_quat(canonical=True)[..., [3,0,1,2]]
+
+def quat_to_rot(q):
+    '''
+    q is a ...-by-4 float array in w, x, y, z order
+    return a scipy Rotation holding all quaternions in q
+    '''
+    q = np.asarray(q, dtype=float)
+    return Rotation.from_quat(q[..., [1,2,3,0]].reshape(-1, 4))
+
+
+def quat_multiply(q1, q2):
+    w1, x1, y1, z1 = np.moveaxis(np.asarray(q1, dtype=float), -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(np.asarray(q2, dtype=float), -1, 0)
+    return np.stack((w1*w2 - x1*x2 - y1*y2 - z1*z2,
+                     w1*x2 + x1*w2 + y1*z2 - z1*y2,
+                     w1*y2 - x1*z2 + y1*w2 + z1*x2,
+                     w1*z2 + x1*y2 - y1*x2 + z1*w2), axis=-1)
+
+def quat_product(qs):
+    '''
+    Ordered product qs[..., 0, :] * qs[..., 1, :] * ... taken along the second to last axis
+    Neighbouring pairs are multiplied in one array operation per round, so n quaternions
+    take log2(n) rounds
+    '''
+    qs = np.asarray(qs, dtype=float)
+    if np.size(qs, -2) == 0:
+        return np.broadcast_to(identity_quat, qs.shape[:-2] + (4,)).copy()
+    while np.size(qs, -2) > 1:
+        num_pair = np.size(qs, -2) // 2
+        paired = quat_multiply(qs[..., 0:2*num_pair:2, :], qs[..., 1:2*num_pair:2, :])
+        qs = np.concatenate((paired, qs[..., 2*num_pair:, :]), axis=-2)
+    return qs[..., 0, :]
+
+def quat_conjugate(q):
+    return np.asarray(q, dtype=float) * np.array([1.0, -1.0, -1.0, -1.0])
+
+def quat_inverse(q):
+    q = np.asarray(q, dtype=float)
+    return quat_conjugate(q) / np.sum(q*q, axis=-1)[..., None]
+
+def quat_exp(q):
+    q = np.asarray(q, dtype=float)
+    vec_norm = np.linalg.norm(q[..., 1:], axis=-1)
+    # sin(|v|)/|v| goes to 1 as |v| goes to 0
+    sinc = np.sinc(vec_norm / np.pi)
+    exp_w = np.exp(q[..., 0])
+    return np.concatenate(((exp_w * np.cos(vec_norm))[..., None], (exp_w * sinc)[..., None] * q[..., 1:]), axis=-1)
+
+def quat_log(q):
+    q = np.asarray(q, dtype=float)
+    vec_norm = np.linalg.norm(q[..., 1:], axis=-1)
+    angle = np.arctan2(vec_norm, q[..., 0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vec_scale = np.where(vec_norm > 0, angle / vec_norm, 1 / q[..., 0])
+    log_vec = vec_scale[..., None] * q[..., 1:]
+    # A negative real quaternion has no unique log, pick the rotation about x like numpy-quaternion
+    log_vec[..., 0] = np.where((vec_norm == 0) & (q[..., 0] < 0), np.pi, log_vec[..., 0])
+    return np.concatenate((np.log(np.linalg.norm(q, axis=-1))[..., None], log_vec), axis=-1)
+
+def quat_power(q, exponent):
+    '''
+    q ** exponent, exponent is a scalar or an array broadcasting with q[..., 0]
+    '''
+    return quat_exp(np.asarray(exponent, dtype=float)[..., None] * quat_log(q))
+
+def quat_slerp(q1, q2, t):
+    '''
+    Spherical linear interpolation from q1 (t=0) to q2 (t=1) along the shorter arc
+    '''
+    q1 = np.asarray(q1, dtype=float)
+    q2 = np.asarray(q2, dtype=float)
+    q2 = np.where((dot(q1, q2) < 0)[..., None], -q2, q2)
+    return quat_multiply(q1, quat_power(quat_multiply(quat_conjugate(q1), q2), t))
+
+def quat_canonicalize(q):
+    '''
+    Flip the sign of every quaternion so that w >= 0
+    '''
+    q = np.asarray(q, dtype=float)
+    return np.where((q[..., 0] < 0)[..., None], -q, q)
+
+def quat_make_continuous(qs):
+    '''
+    qs is an n-by-4 array of unit quaternions
+    Flip signs so every quaternion is on the same hemisphere as the one before it,
+    which makes each consecutive pair interpolate along the shortest arc
+    '''
+    qs = np.asarray(qs, dtype=float)
+    flips = np.where(dot(qs[1:], qs[:-1]) < 0, -1.0, 1.0)
+    signs = np.concatenate(([1.0], np.cumprod(flips)))
+    return qs * signs[:, None]
+
+
+def _cubic_bspline_basis(knots, ts):
+    '''
+    Evaluate the 4 non-zero cubic B-spline basis functions at every t (de Boor-Cox recursion)
+    knots is the knot vector of a cubic B-spline with len(knots)-4 coefficients
+    return the knot span index m of every t, a len(ts)-by-4 array holding B_{m-3}, ..., B_m, and
+    a len(ts)-by-3 array holding the quadratic basis functions N_{m-2}, ..., N_m of the same knots
+    '''
+    knots = np.asarray(knots, dtype=float)
+    ts = np.asarray(ts, dtype=float)
+    num_coefficient = len(knots) - 4
+    spans = np.clip(np.searchsorted(knots, ts, side='right') - 1, 3, num_coefficient - 1)
+    basis = np.zeros((len(ts), 4))
+    basis[:, 0] = 1.0
+    left = np.zeros((len(ts), 4))
+    right = np.zeros((len(ts), 4))
+    for j in range(1, 4):
+        left[:, j] = ts - knots[spans + 1 - j]
+        right[:, j] = knots[spans + j] - ts
+        saved = np.zeros(len(ts))
+        for r in range(j):
+            temp = basis[:, r] / (right[:, r + 1] + left[:, j - r])
+            basis[:, r] = saved + right[:, r + 1] * temp
+            saved = left[:, j - r] * temp
+        basis[:, j] = saved
+        if j == 2:
+            quadratic_basis = basis[:, 0:3].copy()
+    return spans, basis, quadratic_basis
+
+def quat_bspline(control_quats, omegas, knots, ts):
+    '''
+    Evaluate the cumulative-basis cubic quaternion B-spline at every t, refer to
+    http://graphics.cs.cmu.edu/nsp/course/15-464/Fall05/papers/kimKimShin.pdf
+    control_quats: n-by-4 hemisphere-continuous quaternions q_0, ..., q_{n-1}
+    omegas: n-by-4 array where omegas[i] = log(q_{i-1}^-1 * q_i) for i >= 1
+    knots: knot vector of the cubic B-spline with n coefficients
+    return a len(ts)-by-4 array
+    In knot span m the cumulative basis of omegas before m-2 is 1, so their product telescopes
+    to q_{m-3}, and the cumulative basis of omegas after m is 0, so only 3 omegas are touched per t
+    '''
+    spans, basis, _ = _cubic_bspline_basis(knots, np.atleast_1d(ts))
+    cumulative_basis = np.cumsum(basis[:, ::-1], axis=1)[:, ::-1]
+    result_quat = np.asarray(control_quats, dtype=float)[spans - 3]
+    for active_i in range(1, 4):
+        result_quat = quat_multiply(result_quat, quat_exp(cumulative_basis[:, active_i, None] * omegas[spans - 3 + active_i]))
+    return result_quat
+
+def quat_bspline_angular_velocity(control_quats, omegas, knots, ts):
+    '''
+    Body angular velocity (radians per unit t) of the quaternion B-spline from quat_bspline at every t
+    With P_j the product of exp(omega_k * cumulative_basis_k) for the active k >= j, the body angular
+    velocity is 2 * sum_j cumulative_basis_j' * P_j^-1 * omega_j * P_j, and the derivative of the
+    cumulative cubic basis is cumulative_basis_j' = 3 * N_j / (knot_{j+3} - knot_j) with N_j quadratic
+    return a len(ts)-by-3 array
+    '''
+    knots = np.asarray(knots, dtype=float)
+    spans, basis, quadratic_basis = _cubic_bspline_basis(knots, np.atleast_1d(ts))
+    cumulative_basis = np.cumsum(basis[:, ::-1], axis=1)[:, ::-1]
+    body_angular_velocity = np.zeros((len(spans), 4))
+    trailing_product = np.broadcast_to(identity_quat, (len(spans), 4))
+    for active_i in range(3, 0, -1):
+        omega_i = spans - 3 + active_i
+        trailing_product = quat_multiply(quat_exp(cumulative_basis[:, active_i, None] * omegas[omega_i]), trailing_product)
+        d_cumulative_basis = 3 * quadratic_basis[:, active_i-1] / (knots[omega_i+3] - knots[omega_i])
+        rotated_omega = quat_multiply(quat_conjugate(trailing_product), quat_multiply(omegas[omega_i], trailing_product))
+        body_angular_velocity = body_angular_velocity + d_cumulative_basis[:, None] * rotated_omega
+    return 2 * body_angular_velocity[:, 1:]
+
+def quat_bspline_angular_speed(control_quats, omegas, knots, ts):
+    '''
+    Angular speed (radians per unit t) of the quaternion B-spline from quat_bspline at every t
+    return a 1D array
+    '''
+    return np.linalg.norm(quat_bspline_angular_velocity(control_quats, omegas, knots, ts), axis=1)
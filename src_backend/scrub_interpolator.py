@@ -0,0 +1,62 @@
+from scipy.spatial.transform import Rotation
+import numpy as np
+from scipy.interpolate import PchipInterpolator
+
+from orientation_quaternion import rotation_order
+from quaternion_operations import rot_to_quat, quat_to_rot, quat_slerp, quat_make_continuous
+from concatenate_utils import sample_points
+
+class Scrub_Interpolator:
+    # The resolution is chosen by the client, so both the size of a pose table and the number of kept tables are bounded
+    max_pos_and_rot_table_resolution = 8192
+    max_num_pos_and_rot_table = 4
+
+    def __init__(self, pos, rot, ts, sampling_interval):
+        '''
+        pos: n-by-3 np array
+        rot: n-by-3 euler angle given in rotation_order
+        ts: timestamp of each row given in a 1D numpy array
+        sampling_interval: every percent of total video length one sample
+        Answers where the camera is at any progress of the whole video while the user scrubs, without fitting anything.
+        Positions are interpolated by a monotone piecewise cubic spline and orientations by slerp between neighbouring samples
+        '''
+        pos, rot, ts = sample_points(pos, rot, ts, 0.0, 1.0, sampling_interval)
+        self.ts = ts
+        self.pos_spline = PchipInterpolator(ts, pos, axis=0)
+        self.quats = quat_make_continuous(rot_to_quat(Rotation.from_euler(rotation_order, rot)))
+        # Poses at evenly spaced percents, keyed by the number of percents, in the order they were calculated
+        self.pos_and_rot_tables = {}
+
+
+    def get_pos_and_rot_at_percents(self, percents):
+        '''
+        percents: 1D array of progresses through the whole video between 0 and 1
+        return a len(percents)-by-3 np array of positions and a len(percents)-by-3-by-3 np array of rotation matrices
+        '''
+        original_video_ts = np.clip(np.asarray(percents, dtype=float) * self.ts[-1], 0, self.ts[-1])
+        sample_is = np.clip(np.searchsorted(self.ts, original_video_ts, side='right') - 1, 0, len(self.ts)-2)
+        slerp_ts = (original_video_ts - self.ts[sample_is]) / (self.ts[sample_is+1] - self.ts[sample_is])
+        quats = quat_slerp(self.quats[sample_is], self.quats[sample_is+1], slerp_ts)
+        return self.pos_spline(original_video_ts), quat_to_rot(quats).as_matrix()
+
+
+    def get_pos_and_rot_at_percent(self, percent):
+        pos, rot = self.get_pos_and_rot_at_percents([percent])
+        return pos[0].tolist(), rot[0].tolist()
+
+
+    def get_pos_and_rot_table(self, resolution):
+        '''
+        resolution: number of evenly spaced percents from 0 to 1, between 2 and max_pos_and_rot_table_resolution
+        return the percents, the positions and the rotation matrices at them as in get_pos_and_rot_at_percents,
+        which are only calculated the first time a resolution is asked for, the oldest table is dropped once there are
+        more than max_num_pos_and_rot_table of them
+        '''
+        if resolution < 2 or resolution > self.max_pos_and_rot_table_resolution:
+            raise ValueError(f"The resolution of the pose table must be between 2 and {self.max_pos_and_rot_table_resolution}.")
+        if self.pos_and_rot_tables.get(resolution) is None:
+            percents = np.linspace(0, 1, resolution)
+            self.pos_and_rot_tables[resolution] = (percents,) + self.get_pos_and_rot_at_percents(percents)
+            while len(self.pos_and_rot_tables) > self.max_num_pos_and_rot_table:
+                del self.pos_and_rot_tables[next(iter(self.pos_and_rot_tables))]
+        return self.pos_and_rot_tables[resolution]
@@ -11,14 +11,17 @@ import traceback
 import base64
 import pickle
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 import networkx as nx
 
 from stabilizer import Stabilizer
 from stabilize_helper import Stabilize_Helper
-from concatenate_utils import get_relevant_range, generate_initial_concatenate_config_by_order, get_continuously_extracted_frames, get_non_nan_chunk_from_list, get_cur_frame_dict, get_frame_name, generate_register_and_reconstruct_shell_script, generate_render_shell_script, sample_points, generate_render_with_extra_frames_shell_script, frame_index_of
-from fit_path_and_velocity import calc_default_path_and_velocity, get_distance, get_path_control_points_and_t
-from orientation_quaternion import calc_default_orientation_change, rotation_order, get_orientation_control_points_and_t, get_orientation_mat_along_rotation_path, get_path_coord_zero_orientation_mat
-from bezier_curve import bezier, d_bezier
+from scrub_interpolator import Scrub_Interpolator
+from fitted_trajectory import Fitted_Trajectory
+from stabilization_cache import Stabilization_Cache, get_snapshot_path, save_snapshot, load_snapshot, prune_snapshots
+from concatenate_utils import get_relevant_range, generate_initial_concatenate_config_by_order, get_continuously_extracted_frames, get_non_nan_chunk_from_list, get_cur_frame_dict, get_frame_name, generate_register_and_reconstruct_shell_script, generate_render_shell_script, sample_points, generate_render_with_extra_frames_shell_script, frame_index_of, get_registered_ts, get_max_stabilization_strength, get_max_stabilization_strength_table, look_up_max_stabilization_strength, sample_concatenation_clip
+from fit_path_and_velocity import calc_default_path_and_velocity
+from orientation_quaternion import calc_default_orientation_change, rotation_order
 
 
 app = Flask(__name__)
@@ -26,7 +29,26 @@ CORS(app)
 up_vec = None
 tbc_video_info = None
 tbc_stabilizers = {}
-tbc_stabilizers_full_range = {}
+# Timestamps of the registered frames and of the last frame of each video, see get_registered_ts
+tbc_registered_ts = {}
+# Table of the maximum stabilization strength of every trimming range of each stabilizable video, see get_max_stabilization_strength_table
+tbc_max_stabilization_strength_tables = {}
+# Scrub_Interpolator of each video, built in the background and stored as a Future
+tbc_scrub_interpolators = {}
+scrub_interpolator_executor = ThreadPoolExecutor(max_workers=1)
+# Sampling interval of the Stabilize_Helper behind each video's current stabilization
+tbc_helper_sampling_intervals = {}
+# Fitted trajectories and stabilizers of recent stabilization parameters, so going back to them needs no refitting
+stabilization_cache_max_num_entry = 32
+stabilization_cache_max_num_bytes = 512*1024*1024
+stabilization_cache = Stabilization_Cache(stabilization_cache_max_num_entry, stabilization_cache_max_num_bytes)
+# Fitted trajectories are also snapshotted here per project, so they survive server restarts. Snapshots are written
+# in the background, and the least recently used ones are deleted when a project is opened
+stabilization_snapshot_folder = None
+stabilization_snapshot_max_num = 256
+stabilization_snapshot_max_num_bytes = 1024*1024*1024
+stabilization_snapshot_executor = ThreadPoolExecutor(max_workers=1)
+stabilization_source_mtime = None
 final_video_fps = -1
 project_name = None
 project_path = None
@@ -45,11 +67,17 @@ data_device = 'cuda'
 
 # Helper function to clear the exisitng infos
 def clear():
-    global up_vec, tbc_stabilizers, final_video_fps, tbc_video_info, project_path, tbc_stabilizers_full_range, project_name, median_cam_velocity, video_graph
+    global up_vec, tbc_stabilizers, final_video_fps, tbc_video_info, project_path, tbc_registered_ts, tbc_max_stabilization_strength_tables, tbc_scrub_interpolators, tbc_helper_sampling_intervals, stabilization_snapshot_folder, stabilization_source_mtime, project_name, median_cam_velocity, video_graph
     up_vec = None
     tbc_video_info = None
     tbc_stabilizers = {}
-    tbc_stabilizers_full_range = {}
+    tbc_registered_ts = {}
+    tbc_max_stabilization_strength_tables = {}
+    tbc_scrub_interpolators = {}
+    tbc_helper_sampling_intervals = {}
+    stabilization_cache.clear()
+    stabilization_snapshot_folder = None
+    stabilization_source_mtime = None
     final_video_fps = -1
     project_path = None
     project_name = None
@@ -264,6 +292,16 @@ def create_project():
         return jsonify({'error': str(traceback.format_exc())}), 400
 
 
+def get_registered_ts_of(video_name):
+    '''
+    Timestamps of the registered frames of the video, which are only collected from tbc_video_info the first time
+    '''
+    if tbc_registered_ts.get(video_name) is None:
+        cur_video_info = tbc_video_info[video_name]
+        tbc_registered_ts[video_name] = get_registered_ts(cur_video_info['frame_pos'], cur_video_info['frame_ts'])
+    return tbc_registered_ts[video_name]
+
+
 # Receive: {'video_name': (string; name of the video); 'start_percent': (double;
 # the start of current selected range); 'end_percent': (double; the end of the
 # current selected range)}
@@ -280,14 +318,19 @@ def get_maximum_stabilization_strength():
         start_percent = js['start_percent']
         end_percent = js['end_percent']
 
-        # calculate maximum stabilization strength
-        cur_video_info = tbc_video_info[video_name]
-        original_sampling_interval = cur_video_info['original_sampling_interval']
-        cur_stabilization_strength = min(10, int((end_percent - start_percent)/original_sampling_interval/2))
-        _, _, sampled_ts = sample_points(cur_video_info['frame_pos'], cur_video_info['frame_rot'], cur_video_info['frame_ts'], start_percent, end_percent, cur_stabilization_strength*original_sampling_interval)
-        while len(sampled_ts) < 4:
-            cur_stabilization_strength -= 1
-            _, _, sampled_ts = sample_points(cur_video_info['frame_pos'], cur_video_info['frame_rot'], cur_video_info['frame_ts'], start_percent, end_percent, cur_stabilization_strength*original_sampling_interval)
+        # look up maximum stabilization strength if the range is trimmed at sampled_percents, otherwise calculate it
+        max_stabilization_strength_table = tbc_max_stabilization_strength_tables.get(video_name)
+        if not max_stabilization_strength_table is None:
+            sampled_percents = tbc_video_info[video_name]['sampled_percents']
+            start_i = int(np.argmin(np.abs(np.array(sampled_percents) - start_percent)))
+            end_i = int(np.argmin(np.abs(np.array(sampled_percents) - end_percent)))
+            if sampled_percents[start_i] != start_percent or sampled_percents[end_i] != end_percent:
+                max_stabilization_strength_table = None
+        if not max_stabilization_strength_table is None:
+            cur_stabilization_strength = look_up_max_stabilization_strength(max_stabilization_strength_table, start_i, end_i)
+        else:
+            registered_ts, last_ts = get_registered_ts_of(video_name)
+            cur_stabilization_strength = get_max_stabilization_strength(registered_ts, last_ts, start_percent, end_percent, tbc_video_info[video_name]['original_sampling_interval'], 4)
 
         return jsonify({'maximum_stabilization_strength': cur_stabilization_strength}), 200
     except Exception as e:
@@ -318,6 +361,12 @@ def get_maximum_stabilization_strength():
 #  'ts': (list of double)
 #  'suggestion_for_next_clip': (list of strings; names of videos that are suggested)
 #  'trim_for_suggested_clips' = (dict; keys are suggested video names, values are trim index within sampled_percents)
+#  'max_stabilization_strength_table': (list of lists of 10 ints or None; if the video is
+#  stabilizable, entry [i][k-1] is the smallest index j into sampled_percents such that
+#  stabilization strength k is allowed when trimming from sampled_percents[i] to
+#  sampled_percents[j], or -1 if there is no such j. The maximum stabilization strength
+#  of a trimming range is the largest k allowed for it, or 0 if there is none, the same
+#  as /get_maximum_stabilization_strength returns.)
 # } 
 #  (string; another to-be-conatenated video name): {another dict}, ...}
 # Here's the way we sample frames for stabilization, which allows for calculation
@@ -345,7 +394,7 @@ def get_maximum_stabilization_strength():
 def open_project():
     try:
         clear()
-        global tbc_stabilizers, final_video_fps, tbc_video_info, project_path, project_name, shell_repo_path, shell_project_path, original_sampling_interval_sec
+        global tbc_stabilizers, final_video_fps, tbc_video_info, project_path, project_name, shell_repo_path, shell_project_path, original_sampling_interval_sec, stabilization_snapshot_folder, stabilization_source_mtime
 
         # read request
         js = request.get_json()
@@ -364,6 +413,12 @@ def open_project():
         final_video_fps = extract_config['final_video_fps']
         original_sampling_interval_sec = extract_config['original_sampling_interval_sec']
 
+        # Snapshots of earlier stabilizations are only loaded when the same stabilization is asked for again,
+        # and only if the data they were calculated from did not change since
+        stabilization_snapshot_folder = os.path.join(project_path, 'to_be_concatenated', 'stabilization_snapshots')
+        stabilization_source_mtime = max(os.path.getmtime(extract_config_path), os.path.getmtime(tbc_video_info_path))
+        stabilization_snapshot_executor.submit(prune_snapshots, stabilization_snapshot_folder, stabilization_snapshot_max_num, stabilization_snapshot_max_num_bytes)
+
         # For graph-based clip suggestion
         camera_velocities = []
         all_videos_sampled_pos = {}
@@ -417,6 +472,8 @@ def open_project():
 
             # Calculate sampled_percents
             cur_video_dict['sampled_percents'] = None
+            cur_video_dict['max_stabilization_strength_table'] = None
+            tbc_max_stabilization_strength_tables[tbc_video_name] = None
             tbc_video_info[tbc_video_name]['original_sampling_interval'] = np.nan
             cur_video_sampled_pos = []
             cur_video_sampled_rot = []
@@ -462,6 +519,11 @@ def open_project():
                 cur_video_info['sampled_percents'] = cur_video_dict['sampled_percents']
 
                 tbc_video_info[tbc_video_name]['original_sampling_interval'] = extract_config['original_sampling_interval_sec'] / video_total_time
+
+                # Maximum stabilization strength of every trimming range, so trimming needs no calculation
+                registered_ts, last_ts = get_registered_ts_of(tbc_video_name)
+                tbc_max_stabilization_strength_tables[tbc_video_name] = get_max_stabilization_strength_table(registered_ts, last_ts, cur_video_dict['sampled_percents'], tbc_video_info[tbc_video_name]['original_sampling_interval'], 4)
+                cur_video_dict['max_stabilization_strength_table'] = tbc_max_stabilization_strength_tables[tbc_video_name].tolist()
             else:
                 cur_video_sampled_pos.append(np.array(cur_video_info['frame_pos'][0]))
                 cur_video_sampled_pos.append(np.array(cur_video_info['frame_pos'][1]))
@@ -750,6 +812,71 @@ def cancel_stabilization():
         return jsonify({'error': str(traceback.format_exc())}), 400
 
 
+def get_scrub_interpolator_future(video_name):
+    '''
+    Start building the Scrub_Interpolator of the video in the background if it is neither built nor being built yet
+    return the Future of the Scrub_Interpolator
+    '''
+    if tbc_scrub_interpolators.get(video_name) is None:
+        cur_video_info = tbc_video_info[video_name]
+        tbc_scrub_interpolators[video_name] = scrub_interpolator_executor.submit(Scrub_Interpolator, np.array(cur_video_info['frame_pos']), \
+                                                                                np.array(cur_video_info['frame_rot']), np.array(cur_video_info['frame_ts']), \
+                                                                                cur_video_info['original_sampling_interval'])
+    return tbc_scrub_interpolators[video_name]
+
+
+def get_stabilization_snapshot_path(video_name, key):
+    '''
+    return where the value of the stabilization cache key is snapshotted, or None if it should not be snapshotted
+    The mega video only lives in memory, so it is never snapshotted
+    '''
+    if video_name == mega_video_name:
+        return None
+    return get_snapshot_path(stabilization_snapshot_folder, key, stabilization_source_mtime)
+
+
+def get_fitted_trajectory(video_name, pos, rot, ts, start_percent, end_percent, sampling_interval):
+    '''
+    Fit the trajectory of the given video, range and sampling interval only if it is neither in stabilization_cache
+    nor snapshotted yet
+    '''
+    key = ('fitted_trajectory', video_name, start_percent, end_percent, sampling_interval)
+    fitted_trajectory = stabilization_cache.get(key)
+    if fitted_trajectory is None:
+        snapshot_path = get_stabilization_snapshot_path(video_name, key)
+        snapshot = load_snapshot(snapshot_path)
+        if snapshot is None:
+            fitted_trajectory = Fitted_Trajectory(pos, rot, ts, start_percent, end_percent, sampling_interval)
+            if not snapshot_path is None:
+                stabilization_snapshot_executor.submit(save_snapshot, snapshot_path, fitted_trajectory.get_snapshot())
+        else:
+            fitted_trajectory = Fitted_Trajectory.from_snapshot(snapshot)
+        stabilization_cache.put(key, fitted_trajectory)
+    return fitted_trajectory
+
+
+def get_stabilizer(video_name, pos, rot, ts, start_percent, end_percent, sampling_interval, helper_sampling_interval, local_velocity_adjustment_curve_x, local_velocity_adjustment_curve_y):
+    '''
+    Stabilize the given video with the given parameters only if the Stabilizer is not in stabilization_cache yet
+    Only the fitted trajectories it is made from are snapshotted, since they are what takes long to calculate
+    The key leaves out the local velocity adjustment curve, so editing the curve does not fill the cache with Stabilizers of
+    the same range, a cached Stabilizer of another curve is given the new curve instead
+    '''
+    key = ('stabilizer', video_name, start_percent, end_percent, sampling_interval, helper_sampling_interval, final_video_fps)
+    stabilizer = stabilization_cache.get(key)
+    if stabilizer is None:
+        fitted_trajectory = get_fitted_trajectory(video_name, pos, rot, ts, start_percent, end_percent, sampling_interval)
+        dense_ts, dense_distances_of_timestamped_pos_from_start, dense_distances_of_timestamped_rot_from_start = Stabilize_Helper(pos, rot, ts, start_percent, end_percent, helper_sampling_interval, \
+            fitted_trajectory=get_fitted_trajectory(video_name, pos, rot, ts, start_percent, end_percent, helper_sampling_interval)).get_original_ts_to_distance_dense_mapping()
+        stabilizer = Stabilizer(pos, rot, ts, start_percent, end_percent, sampling_interval, local_velocity_adjustment_curve_x, local_velocity_adjustment_curve_y, final_video_fps, dense_ts, dense_distances_of_timestamped_pos_from_start, dense_distances_of_timestamped_rot_from_start, \
+            fitted_trajectory=fitted_trajectory)
+        stabilization_cache.put(key, stabilizer)
+    if not np.array_equal(stabilizer.local_velocity_adjustment_curve_x, local_velocity_adjustment_curve_x) or \
+            not np.array_equal(stabilizer.local_velocity_adjustment_curve_y, local_velocity_adjustment_curve_y):
+        stabilizer.set_local_velocity_adjustment_curve(local_velocity_adjustment_curve_x, local_velocity_adjustment_curve_y)
+    return stabilizer
+
+
 # Stabilize video
 # Receive: 
 # {'video_name': (string; name of the stabilized video),
@@ -772,7 +899,7 @@ def cancel_stabilization():
 @app.route('/stabilize_video', methods=['POST'])
 def stabilize_video():
     try:
-        global tbc_stabilizers, final_video_fps, tbc_video_info, tbc_stabilizers_full_range
+        global tbc_stabilizers, final_video_fps, tbc_video_info, tbc_helper_sampling_intervals
 
         # read request
         js = request.get_json()
@@ -790,11 +917,12 @@ def stabilize_video():
         ts = np.array(cur_video_info['frame_ts'])
         # Not stabilized at all before
         if tbc_stabilizers[video_name] is None:
-            dense_ts, dense_distances_of_timestamped_pos_from_start, dense_distances_of_timestamped_rot_from_start = Stabilize_Helper(pos, rot, ts, start_percent, end_percent, tbc_video_info[video_name]['original_sampling_interval']*max(1, int(js['stabilization_strength']/3))).get_original_ts_to_distance_dense_mapping()
-            tbc_stabilizers[video_name] = Stabilizer(pos, rot, ts, start_percent, end_percent, sampling_interval, local_velocity_adjustment_curve_x, local_velocity_adjustment_curve_y, final_video_fps, dense_ts, dense_distances_of_timestamped_pos_from_start, dense_distances_of_timestamped_rot_from_start)
+            # Prepare for dragging slider, built in the background while stabilizing
+            get_scrub_interpolator_future(video_name)
 
-            # Prepare for dragging slider
-            tbc_stabilizers_full_range[video_name] = Stabilizer(pos, rot, ts, 0.0, 1.0, tbc_video_info[video_name]['original_sampling_interval'], [i/9 for i in range(10)], [1 for i in range(10)], final_video_fps, dense_ts, dense_distances_of_timestamped_pos_from_start, dense_distances_of_timestamped_rot_from_start)
+            helper_sampling_interval = tbc_video_info[video_name]['original_sampling_interval']*max(1, int(js['stabilization_strength']/3))
+            tbc_helper_sampling_intervals[video_name] = helper_sampling_interval
+            tbc_stabilizers[video_name] = get_stabilizer(video_name, pos, rot, ts, start_percent, end_percent, sampling_interval, helper_sampling_interval, local_velocity_adjustment_curve_x, local_velocity_adjustment_curve_y)
         # Previously stabilized
         else:
             prev_selected_range, prev_sampling_interval = tbc_stabilizers[video_name].get_stabilization_params()
@@ -803,20 +931,15 @@ def stabilize_video():
                 tbc_stabilizers[video_name].set_local_velocity_adjustment_curve(local_velocity_adjustment_curve_x, local_velocity_adjustment_curve_y)
             # Changed selected range or sampling interval
             else:
-                dense_ts, dense_distances_of_timestamped_pos_from_start, dense_distances_of_timestamped_rot_from_start = Stabilize_Helper(pos, rot, ts, start_percent, end_percent, tbc_video_info[video_name]['original_sampling_interval']).get_original_ts_to_distance_dense_mapping()
-                tbc_stabilizers[video_name] = Stabilizer(pos, rot, ts, start_percent, end_percent, sampling_interval, local_velocity_adjustment_curve_x, local_velocity_adjustment_curve_y, final_video_fps, dense_ts, dense_distances_of_timestamped_pos_from_start, dense_distances_of_timestamped_rot_from_start)
+                tbc_helper_sampling_intervals[video_name] = tbc_video_info[video_name]['original_sampling_interval']
+                tbc_stabilizers[video_name] = get_stabilizer(video_name, pos, rot, ts, start_percent, end_percent, sampling_interval, tbc_helper_sampling_intervals[video_name], local_velocity_adjustment_curve_x, local_velocity_adjustment_curve_y)
                 
         # get the stabilization result
         stabilized_pos, stabilized_rot, stabilized_ts, stabilized_ts_original, vsp, vsm = tbc_stabilizers[video_name].get_stabilization_result()
 
         # calculate maximum stabilization strength
-        cur_video_info = tbc_video_info[video_name]
-        original_sampling_interval = cur_video_info['original_sampling_interval']
-        cur_stabilization_strength = min(10, int((end_percent - start_percent)/original_sampling_interval/2))
-        _, _, sampled_ts = sample_points(cur_video_info['frame_pos'], cur_video_info['frame_rot'], cur_video_info['frame_ts'], start_percent, end_percent, cur_stabilization_strength*original_sampling_interval)
-        while len(sampled_ts) <= 4:
-            cur_stabilization_strength -= 1
-            _, _, sampled_ts = sample_points(cur_video_info['frame_pos'], cur_video_info['frame_rot'], cur_video_info['frame_ts'], start_percent, end_percent, cur_stabilization_strength*original_sampling_interval)
+        registered_ts, last_ts = get_registered_ts_of(video_name)
+        cur_stabilization_strength = get_max_stabilization_strength(registered_ts, last_ts, start_percent, end_percent, tbc_video_info[video_name]['original_sampling_interval'], 5)
 
         # Update mega video if we stabilize mega video
         if video_name == mega_video_name:
@@ -852,15 +975,13 @@ def stabilize_video():
 @app.route('/get_pos_and_rot_at_progress_percent', methods=['POST'])
 def get_pos_and_rot_at_progress_percent():
     try:
-        global tbc_stabilizers_full_range
-
         # read request
         js = request.get_json()
         video_name = js['video_name']
         percent = js['percent']
 
         # Get pos and rot
-        pos, rot = tbc_stabilizers_full_range[video_name].get_pos_and_rot_at_percent(percent)
+        pos, rot = get_scrub_interpolator_future(video_name).result().get_pos_and_rot_at_percent(percent)
 
         return jsonify({'pos': pos, 'rot': rot}), 200
     except Exception as e:
@@ -868,6 +989,35 @@ def get_pos_and_rot_at_progress_percent():
         return jsonify({'error': str(traceback.format_exc())}), 400
 
 
+# Responsive API, use to get many poses at once, e.g. to prefetch the whole scrub track of a video
+# Receive: {'video_name': (string; name of the video), 'percents': (optional list of floats; the percents to get poses at),
+# 'resolution': (optional int; get poses at this many evenly spaced percents from 0 to 1 instead, served from a precomputed table)}
+# Return: {'num_pose': (int), 'percents': (string; base64 of the little-endian float32 array of percents),
+# 'pos': (string; base64 of the num_pose-by-3 little-endian float32 array of positions, row major),
+# 'rot': (string; base64 of the num_pose-by-3-by-3 little-endian float32 array of rotation matrices, row major)}
+@app.route('/get_pos_and_rot_at_progress_percents', methods=['POST'])
+def get_pos_and_rot_at_progress_percents():
+    try:
+        # read request
+        js = request.get_json()
+        video_name = js['video_name']
+
+        # Get pos and rot
+        scrub_interpolator = get_scrub_interpolator_future(video_name).result()
+        if js.get('percents') is None:
+            percents, pos, rot = scrub_interpolator.get_pos_and_rot_table(int(js['resolution']))
+        else:
+            percents = np.array(js['percents'], dtype=float)
+            pos, rot = scrub_interpolator.get_pos_and_rot_at_percents(percents)
+
+        packed_arrays = {name: base64.b64encode(np.ascontiguousarray(array, dtype='<f4').tobytes()).decode('utf-8') \
+                         for name, array in [('percents', percents), ('pos', pos), ('rot', rot)]}
+        return jsonify({'num_pose': len(percents), **packed_arrays}), 200
+    except Exception as e:
+        print(traceback.format_exc())
+        return jsonify({'error': str(traceback.format_exc())}), 400
+
+
 # Receive: {'video_name': (string; name of the requested video)}
 # Return: {'pos': (list; list of position vectors), 'rot': (list of rotation matrices), 'ts': (list; timestamps for each pos and rot)}
 # If a video just cannot be concatenated under the current setting, the values in the returned dict will all be None
@@ -1034,46 +1184,22 @@ def concatenate_video():
             # Deal with concatenation clip
             cur_clip_video_name = f'concatenation_clip_{concatenate_dict_i+1}'
             cur_seg_config = {'video_name': cur_clip_video_name, 'frame_indexes': [], 'blend': []}
-            path_control_points = concatenate_dict['path_control_points']
-            path_lengths = concatenate_dict['path_lengths']
-            initial_velocities = concatenate_dict['initial_velocities']
-            accels_along_path = concatenate_dict['accels_along_path']
-            travel_times = concatenate_dict['travel_times']
-            orientation_control_points = concatenate_dict['orientation_control_points']
-            transition_refs = concatenate_dict['transition_refs']
-            transition_times = concatenate_dict['transition_times']
-            cur_time_in_concatenate_clip = time_between_frames
-            cur_frame_index = 0
-            total_travel_time = np.sum(travel_times)
-            while not np.isclose(cur_time_in_concatenate_clip, total_travel_time):
-                # Calculate pos
-                cur_distance_along_whole_path = get_distance(initial_velocities, accels_along_path, travel_times, cur_time_in_concatenate_clip)
-                curve_control_points, t_along_curve = get_path_control_points_and_t(path_control_points, path_lengths, cur_distance_along_whole_path)
-                cur_pos = bezier(curve_control_points, t_along_curve).tolist()
-
-                # Calculate orientation
-                orientation_curve_control_points, t_along_orientation_curve, cur_transition_ref = get_orientation_control_points_and_t(orientation_control_points, transition_refs, transition_times, cur_time_in_concatenate_clip)
-                if cur_transition_ref == 'world':
-                    cur_rot = get_orientation_mat_along_rotation_path(orientation_curve_control_points, t_along_orientation_curve).tolist()
-                elif cur_transition_ref == 'path':
-                    cur_path_tangent = d_bezier(curve_control_points, t_along_curve)
-                    path_ref_mat = get_path_coord_zero_orientation_mat(cur_path_tangent, up_vec)
-                    rot_mat_in_path_ref = get_orientation_mat_along_rotation_path(orientation_curve_control_points, t_along_orientation_curve)
-                    cur_rot = (path_ref_mat @ rot_mat_in_path_ref).tolist()
-
-
-                # Append to things
+            total_travel_time = np.sum(concatenate_dict['travel_times'])
+            num_clip_frame = int(np.round(total_travel_time / time_between_frames)) - 1
+            times_in_concatenate_clip = np.arange(1, num_clip_frame+1) * time_between_frames
+            clip_pos, clip_rot = sample_concatenation_clip(concatenate_dict, times_in_concatenate_clip, up_vec)
+            clip_pos = clip_pos.tolist()
+            clip_rot = clip_rot.tolist()
+            for cur_frame_index in range(num_clip_frame):
+                cur_pos = clip_pos[cur_frame_index]
+                cur_rot = clip_rot[cur_frame_index]
                 concatenate_frames.append(get_cur_frame_dict(cam_intrinsic_params, cur_pos, cur_rot, cur_clip_video_name + f'_{cur_frame_index:08d}.png'))
                 cur_seg_config['frame_indexes'].append(cur_frame_index)
                 cur_seg_config['blend'].append(0)
                 frontend_pos.append(cur_pos)
                 frontend_rot.append(cur_rot)
-                frontend_ts.append(last_video_end_time + cur_time_in_concatenate_clip)
+                frontend_ts.append(last_video_end_time + float(times_in_concatenate_clip[cur_frame_index]))
                 frontend_frames.append(None)
-
-                # Increment time and frame index
-                cur_time_in_concatenate_clip += time_between_frames
-                cur_frame_index += 1
             
             # Append to final_video_config_list
             final_video_config_list.append(cur_seg_config)
@@ -1154,7 +1280,7 @@ def concatenate_video():
 
 
         # Create the mega video for further processing
-        global original_sampling_interval_sec, tbc_stabilizers_full_range
+        global original_sampling_interval_sec, tbc_scrub_interpolators, tbc_registered_ts, tbc_max_stabilization_strength_tables
         mega_video_original_sampling_interval = original_sampling_interval_sec/frontend_ts[-1]
         tbc_video_info[mega_video_name] = {}
         tbc_video_info[mega_video_name]['original_sampling_interval'] = mega_video_original_sampling_interval
@@ -1173,7 +1299,11 @@ def concatenate_video():
         tbc_video_info[mega_video_name]['final_video_config'] = final_video_config
         tbc_video_info[mega_video_name]['concatenate_frames'] = concatenate_frames
         tbc_stabilizers[mega_video_name] = None
-        tbc_stabilizers_full_range[mega_video_name] = None
+        tbc_scrub_interpolators[mega_video_name] = None
+        tbc_registered_ts[mega_video_name] = None
+        tbc_max_stabilization_strength_tables[mega_video_name] = None
+        # The mega video is made again, so nothing cached for the previous one is valid
+        stabilization_cache.remove_if(lambda key: key[1] == mega_video_name)
         sampled_percents = (np.array(mega_video_ts) / mega_video_ts[-1]).tolist()
        
                     
@@ -0,0 +1,154 @@
+from collections import OrderedDict
+import threading
+import hashlib
+import os
+import zipfile
+import sys
+import numpy as np
+
+
+def estimate_num_bytes(value, counted_ids=None):
+    '''
+    Estimate the memory held by value by walking through its numpy arrays, containers and object attributes
+    Every object is only counted once, even if it is reachable from several places
+    '''
+    if counted_ids is None:
+        counted_ids = set()
+    if id(value) in counted_ids:
+        return 0
+    counted_ids.add(id(value))
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum([estimate_num_bytes(element, counted_ids) for element in value])
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum([estimate_num_bytes(k, counted_ids) + estimate_num_bytes(v, counted_ids) for k, v in value.items()])
+    if hasattr(value, '__dict__'):
+        return sys.getsizeof(value) + estimate_num_bytes(vars(value), counted_ids)
+    return sys.getsizeof(value)
+
+
+class Stabilization_Cache:
+    def __init__(self, max_num_entry=32, max_num_bytes=512*1024*1024):
+        '''
+        Least recently used cache of fitted trajectories and stabilizers
+        max_num_entry: the least recently used entries are evicted when there are more entries than this
+        max_num_bytes: the least recently used entries are evicted when the estimated memory of all entries is more than this,
+        the most recently added entry is always kept even if it alone is larger
+        '''
+        self.max_num_entry = max_num_entry
+        self.max_num_bytes = max_num_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        '''
+        return the cached value of key and mark it as the most recently used, or None if key is not cached
+        '''
+        with self.lock:
+            if not key in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+
+    def put(self, key, value):
+        '''
+        Cache value under key as the most recently used entry, then evict until both limits are met
+        '''
+        num_bytes = estimate_num_bytes(value)
+        with self.lock:
+            if key in self.entries:
+                self.num_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, num_bytes)
+            self.num_bytes += num_bytes
+            while len(self.entries) > 1 and (len(self.entries) > self.max_num_entry or self.num_bytes > self.max_num_bytes):
+                _, (_, evicted_num_bytes) = self.entries.popitem(last=False)
+                self.num_bytes -= evicted_num_bytes
+
+
+    def remove_if(self, is_to_be_removed):
+        '''
+        Remove every entry whose key makes is_to_be_removed return True
+        '''
+        with self.lock:
+            for key in [key for key in self.entries if is_to_be_removed(key)]:
+                self.num_bytes -= self.entries.pop(key)[1]
+
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.num_bytes = 0
+
+
+def get_snapshot_path(snapshot_folder, key, source_mtime):
+    '''
+    snapshot_folder: folder holding the snapshots of one project, or None if snapshots are not kept
+    key: the stabilization cache key of the snapshotted value
+    source_mtime: modification time of the data the value is calculated from, so a snapshot is never used after that data changes
+    return the path of the .npz snapshot file, or None
+    '''
+    if snapshot_folder is None:
+        return None
+    key_hash = hashlib.sha1(repr((key, source_mtime)).encode('utf-8')).hexdigest()
+    return os.path.join(snapshot_folder, key_hash + '.npz')
+
+
+def save_snapshot(snapshot_path, snapshot):
+    '''
+    Write the dict of np arrays to snapshot_path, the file only appears once it is complete
+    '''
+    if snapshot_path is None:
+        return
+    os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+    temp_snapshot_path = snapshot_path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.temp'
+    with open(temp_snapshot_path, 'wb') as file:
+        np.savez(file, **snapshot)
+    os.replace(temp_snapshot_path, snapshot_path)
+
+
+def load_snapshot(snapshot_path):
+    '''
+    return the dict of np arrays saved at snapshot_path, or None if there is no readable snapshot there
+    '''
+    if snapshot_path is None or not os.path.exists(snapshot_path):
+        return None
+    try:
+        with np.load(snapshot_path) as file:
+            snapshot = {name: file[name] for name in file.files}
+        # Mark it as recently used, so prune_snapshots keeps it
+        os.utime(snapshot_path)
+        return snapshot
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+
+
+def prune_snapshots(snapshot_folder, max_num_snapshot, max_num_bytes):
+    '''
+    Delete the least recently used snapshots in snapshot_folder until there are at most max_num_snapshot of them
+    and they take at most max_num_bytes on disk
+    '''
+    if snapshot_folder is None or not os.path.isdir(snapshot_folder):
+        return
+    snapshots = []
+    for file_name in os.listdir(snapshot_folder):
+        if not file_name.endswith('.npz'):
+            continue
+        try:
+            file_stat = os.stat(os.path.join(snapshot_folder, file_name))
+        except OSError:
+            continue
+        snapshots.append((file_stat.st_mtime, file_stat.st_size, file_name))
+    snapshots.sort(reverse=True)
+    num_bytes = 0
+    for snapshot_i, (_, snapshot_num_bytes, file_name) in enumerate(snapshots):
+        num_bytes += snapshot_num_bytes
+        if snapshot_i >= max_num_snapshot or num_bytes > max_num_bytes:
+            try:
+                os.remove(os.path.join(snapshot_folder, file_name))
+            except OSError:
+                pass
@@ -72,6 +72,30 @@ export function get_pos_and_rot_at_progress_percent(videoSlug: string, progress:
   return POST("get_pos_and_rot_at_progress_percent", {video_name: videoSlug, percent: progress});
 }
 
+function decodeFloat32Array(base64: string) {
+  const binary = atob(base64);
+  const bytes = new Uint8Array(binary.length);
+  for (let i = 0; i < binary.length; i++) {
+    bytes[i] = binary.charCodeAt(i);
+  }
+  return new Float32Array(bytes.buffer);
+}
+
+// Give either the progresses to get poses at, or a resolution to get that many evenly spaced poses from 0 to 1.
+// pos holds 3 and rot holds 9 (row major rotation matrix) numbers per pose
+export async function get_pos_and_rot_at_progress_percents(videoSlug: string, progresses?: number[], resolution?: number) {
+  const res = await POST<{num_pose: number, percents: string, pos: string, rot: string}>(
+    "get_pos_and_rot_at_progress_percents",
+    {video_name: videoSlug, percents: progresses, resolution: resolution}
+  );
+  return {
+    num_pose: res.num_pose,
+    percents: decodeFloat32Array(res.percents),
+    pos: decodeFloat32Array(res.pos),
+    rot: decodeFloat32Array(res.rot),
+  };
+}
+
 export function stabilizeVideo(
   videoName: string,
   stabilizationStrength: number = 1,
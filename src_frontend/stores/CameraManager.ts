@@ -2,9 +2,13 @@ import { makeAutoObservable } from "mobx";
 import { CameraState, cameraStateLoader } from "../api/cameraTrajectoryLoader";
 import { clamp } from "@/utils/mathUtils";
 import { Camera } from "@react-three/fiber";
-import { PerspectiveCamera } from "three";
+import { PerspectiveCamera, Matrix4, Quaternion } from "three";
 import { VideoStates } from "./VideoStates";
-import { get_pos_and_rot_at_progress_percent } from "@/api/server";
+import { get_pos_and_rot_at_progress_percent, get_pos_and_rot_at_progress_percents } from "@/api/server";
+
+// Number of evenly spaced poses of the whole original video prefetched for scrubbing, must be one the server serves
+const scrub_pose_table_resolution = 2048;
+type ScrubPoseTable = { num_pose: number; percents: Float32Array; pos: Float32Array; rot: Float32Array };
 
 export type WebglCanvasType = "cameraViewCanvas" | "ThirdPersonViewCanvas";
 export class CameraManager {
@@ -50,6 +54,8 @@ export class CameraManager {
   velocityEditorProgressShouldFollowMouse: boolean = true;
   allowKeyboardControl: boolean = true;
   isDraggingProgressBar: boolean = false;
+  scrub_pose_table?: ScrubPoseTable;
+  scrub_pose_table_request?: Promise<void>;
 
   constructor(videoSlug: string, cameraTrajectory: CameraState[], cam_fov_y: number, cam_aspect_ratio: number) {
     makeAutoObservable(
@@ -79,13 +85,54 @@ export class CameraManager {
       const original_ts_progress = (original_progress-start_progress)/(end_progress-start_progress);
       const current_progress = this.find_current_progress_by_original_progress(original_ts_progress, 0, 1, -1);
       this.setCurrentProgress(current_progress);
+    } else if (this.scrub_pose_table !== undefined) {
+      this.setCameraState("cameraViewCanvas", this.get_scrub_camera_state(original_progress));
     } else {
+      // Ask for this pose alone until the poses of the whole video arrive
+      this.prefetch_scrub_pose_table();
       get_pos_and_rot_at_progress_percent(this.parent_video_state?.videoSlug, original_progress).then((res) => {
         this.setCameraState("cameraViewCanvas", cameraStateLoader(res.pos, res.rot));
       });
     }
   }
 
+  // Fetch the poses of the whole original video at evenly spaced progresses once, so scrubbing outside the stabilized
+  // range is interpolated here instead of asking the server for every pose
+  prefetch_scrub_pose_table() {
+    if (this.scrub_pose_table !== undefined || this.scrub_pose_table_request !== undefined || this.parent_video_state === undefined) {
+      return;
+    }
+    const request: Promise<void> = get_pos_and_rot_at_progress_percents(this.parent_video_state.videoSlug, undefined, scrub_pose_table_resolution)
+      .then((res) => this.set_scrub_pose_table(request, res))
+      .catch(() => this.set_scrub_pose_table(request, undefined));
+    this.scrub_pose_table_request = request;
+  }
+
+  // Only the latest request sets the table, a request made before the trajectory changed is ignored
+  set_scrub_pose_table(request: Promise<void>, scrub_pose_table?: ScrubPoseTable) {
+    if (this.scrub_pose_table_request !== request) {
+      return;
+    }
+    this.scrub_pose_table = scrub_pose_table;
+    if (scrub_pose_table === undefined) {
+      this.scrub_pose_table_request = undefined;
+    }
+  }
+
+  // Pose at original_progress of the whole original video, position interpolated linearly and rotation by slerp
+  // between the two closest poses of the prefetched table
+  get_scrub_camera_state(original_progress: number) {
+    const { num_pose, pos, rot } = this.scrub_pose_table!;
+    const table_progress = clamp(original_progress, 0, 1) * (num_pose - 1);
+    const pose_i = Math.min(Math.floor(table_progress), num_pose - 2);
+    const t = table_progress - pose_i;
+    const position = [0, 1, 2].map((k) => pos[3*pose_i+k] * (1-t) + pos[3*(pose_i+1)+k] * t);
+    const quaternion = rotationQuaternionOf(rot, pose_i).slerp(rotationQuaternionOf(rot, pose_i+1), t);
+    const elements = new Matrix4().makeRotationFromQuaternion(quaternion).elements; // column major
+    const rotationMat = [0, 1, 2].map((row) => [0, 1, 2].map((col) => elements[col*4+row]));
+    return cameraStateLoader(position, rotationMat);
+  }
+
   find_current_progress_by_original_progress(goal_original_progress: number, current_guess_lower: number, current_guess_higher: number, last_index: number) {
     const current_guess = current_guess_lower/2 + current_guess_higher/2;
     const closestIndex = this.getClosestIndexByProgress(current_guess);
@@ -112,6 +159,9 @@ export class CameraManager {
   }
   setIsDraggingProgressBar(isDraggingProgress: boolean) {
     this.isDraggingProgressBar = isDraggingProgress;
+    if (isDraggingProgress) {
+      this.prefetch_scrub_pose_table();
+    }
   }
 
   toggleVelocityEditorProgressShouldFollowMouse() {
@@ -138,6 +188,9 @@ export class CameraManager {
 
   updateCameraTrajectory(cameraTrajectory: CameraState[]) {
     this.cameraTrajectory = cameraTrajectory;
+    // The server may have rebuilt the video, e.g. the mega video, so fetch its poses again when scrubbing next
+    this.scrub_pose_table = undefined;
+    this.scrub_pose_table_request = undefined;
     const color_array = hexToRgbArray(this.parent_video_state?.video_color);
     this.camera_trajectory_mesh_color_array = new Array(cameraTrajectory.length).fill(0).flatMap((_, i) => color_array);
   }
@@ -359,6 +412,13 @@ export function canvasTypeFormatter(canvasType: WebglCanvasType) {
 }
 
 
+// Rotation of the pose_i-th row major rotation matrix packed in rot
+function rotationQuaternionOf(rot: Float32Array, pose_i: number) {
+  const m = rot.subarray(9*pose_i, 9*pose_i+9);
+  const matrix = new Matrix4().set(m[0], m[1], m[2], 0, m[3], m[4], m[5], 0, m[6], m[7], m[8], 0, 0, 0, 0, 1);
+  return new Quaternion().setFromRotationMatrix(matrix);
+}
+
 function hexToRgbArray(hex: string): [number, number, number] {
   // Remove the "#" if it exists
   hex = hex.replace(/^#/, '');
@@ -15,6 +15,7 @@ export class VideoStates {
   is_before_other_video_ok: boolean = true;
   is_after_other_video_ok: boolean = true;
   sampled_percents: Array<number> = [];
+  max_stabilization_strength_table: Array<Array<number>> | null = null;
   cur_trim_start: number = 0;
   cur_trim_end: number = 1;
   stabilized_trim_start: number = 0;
@@ -31,7 +32,7 @@ export class VideoStates {
   is_suggested_to_be_stabilized: boolean = false;
   note: string = "";
 
-  constructor(videoSlug: string, videoUrl: string, is_stabilizable: boolean, is_before_other_video_ok: boolean, is_after_other_video_ok: boolean, sampled_percents: Array<number>) {
+  constructor(videoSlug: string, videoUrl: string, is_stabilizable: boolean, is_before_other_video_ok: boolean, is_after_other_video_ok: boolean, sampled_percents: Array<number>, max_stabilization_strength_table: Array<Array<number>> | null = null) {
     makeAutoObservable(this, {set_is_stabilized: action}, { autoBind: true });
     this.videoSlug = videoSlug;
     this.videoUrl = videoUrl;
@@ -43,6 +44,7 @@ export class VideoStates {
     this.is_after_other_video_ok = is_after_other_video_ok;
     if (this.is_stabilizable) {
       this.sampled_percents = sampled_percents;
+      this.max_stabilization_strength_table = max_stabilization_strength_table;
     } else {
       this.sampled_percents = [0,1]
     }
@@ -123,6 +125,7 @@ export class VideoStates {
 
   set_sampled_percents(sampled_percents: Array<number>) {
     this.sampled_percents = sampled_percents;
+    this.max_stabilization_strength_table = null;
     this.stabilized_trim_start = 0;
     this.stabilized_trim_end = this.sampled_percents.length-1;
     this.cur_trim_start = 0;
@@ -177,10 +180,26 @@ export class VideoStates {
     } else if (max_value === this.cur_trim_end) {
       this.cur_trim_start = this.cur_trim_end - 4;
     }
+    if (this.max_stabilization_strength_table !== null) {
+      this.set_max_stabilization_strength(this.look_up_max_stabilization_strength(this.cur_trim_start, this.cur_trim_end));
+      return;
+    }
     const res = await getMaxStabilizationStrength(this.videoSlug, this.sampled_percents[this.cur_trim_start], this.sampled_percents[this.cur_trim_end])
     this.set_max_stabilization_strength(res.maximum_stabilization_strength);
   }
 
+  // Same as the server's look_up_max_stabilization_strength: the largest strength whose smallest trim end is before trim_end
+  look_up_max_stabilization_strength(trim_start: number, trim_end: number) {
+    const min_trim_ends = this.max_stabilization_strength_table![trim_start];
+    for (let stabilization_strength = min_trim_ends.length; stabilization_strength > 0; stabilization_strength--) {
+      const min_trim_end = min_trim_ends[stabilization_strength-1];
+      if (min_trim_end >= 0 && min_trim_end <= trim_end) {
+        return stabilization_strength;
+      }
+    }
+    return 0;
+  }
+
   get totalTime() {
     return this.cameraManager?.totalTime;
   }
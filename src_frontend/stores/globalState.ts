@@ -46,7 +46,7 @@ export class GlobalState {
     for (let video_i = 0; video_i < all_videos.length; video_i++) {
       const cur_video_name = all_videos[video_i];
       const videoUrl = "../../data/" + this.project_name + "/to_be_concatenated/" + cur_video_name;
-      this.videoStatesStore[cur_video_name] = new VideoStates(cur_video_name, videoUrl, open_project_response[cur_video_name].is_stabilizable, open_project_response[cur_video_name].is_before_other_video_ok, open_project_response[cur_video_name].is_after_other_video_ok, open_project_response[cur_video_name].sampled_percents);
+      this.videoStatesStore[cur_video_name] = new VideoStates(cur_video_name, videoUrl, open_project_response[cur_video_name].is_stabilizable, open_project_response[cur_video_name].is_before_other_video_ok, open_project_response[cur_video_name].is_after_other_video_ok, open_project_response[cur_video_name].sampled_percents, open_project_response[cur_video_name].max_stabilization_strength_table);
       this.videoStatesStore[cur_video_name].setCameraManager(new CameraManager(cur_video_name, convert_to_cameraTrajectory(open_project_response[cur_video_name].pos, open_project_response[cur_video_name].rot, open_project_response[cur_video_name].ts, open_project_response[cur_video_name].ts), this.cam_fov_y, this.cam_aspect_ratio))
       this.videoStatesStore[cur_video_name].set_video_color(hslToHex(360/all_videos.length*video_i, 100, 50));
       this.videoStatesStore[cur_video_name].cameraManager.set_parent_video_state(this.videoStatesStore[cur_video_name]);
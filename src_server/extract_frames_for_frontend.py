@@ -17,6 +17,9 @@ to_be_concatenated_file_names = sorted(list(extract_config['tbc_file_extracted_f
 frontend_frame_dir = os.path.join(tbc_path, 'for_frontend')
 os.makedirs(frontend_frame_dir, exist_ok=True)
 for tbc_video_name in to_be_concatenated_file_names:
+    # extract_video_frames.py already makes the frames of the videos it can read in the same pass as extracting them
+    if os.path.exists(os.path.join(frontend_frame_dir, tbc_video_name+'.pickle')):
+        continue
     video_capture = cv2.VideoCapture(os.path.join(tbc_path, tbc_video_name))
     width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
@@ -2,46 +2,21 @@ import cv2
 import os
 from argparse import ArgumentParser
 import json
+import base64
+import pickle
 from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import threading
 
 video_file_suffix = ['mov', 'MOV', 'mp4']
 image_file_suffix = ['jpeg', 'png', 'jpg']
+# Extracted frames at most this many frames after the last read one are reached by decoding the frames in between,
+# farther ones by seeking, which decodes from the keyframe before them (about half a keyframe interval of phone videos)
+max_num_frame_to_decode_instead_of_seeking = 30
+# Threads encoding and writing the JPEGs and frontend thumbnails of one video while it is decoded, and how many decoded frames may wait for them
+num_jpeg_writer_per_video = 4
+max_num_frame_waiting_to_be_written = 16
 
-parser = ArgumentParser("Extract Environment Scan and To-be-concatenated Video Frames")
-parser.add_argument("--source_path", "-s", required=True, type=str)
-parser.add_argument("--num_extracted_frame_per_sec_for_tbc_videos", "-tbcfps", default="10", type=str)
-parser.add_argument("--num_extracted_frame_for_tbc_videos_at_two_ends", "-tbctef", default="-1", type=str)
-parser.add_argument("--num_extracted_frame_per_sec_for_env_scan_videos", "-esfps", default="2", type=str)
-args = parser.parse_args()
-
-# Format source path
-source = args.source_path
-source = source.replace("\\", "/")
-
-# Read extraction fps
-tbc_extraction_fps = float(args.num_extracted_frame_per_sec_for_tbc_videos)
-env_scan_extraction_fps = float(args.num_extracted_frame_per_sec_for_env_scan_videos)
-
-# Scan to-be-concatenated videos and prepare dir for frames
-with open(os.path.join(source, 'to_be_concatenated/extract_config.json'), 'r') as file:
-    extract_config = json.load(file)
-extract_config['original_sampling_interval_sec'] = 1/tbc_extraction_fps
-with open(os.path.join(source, 'to_be_concatenated/extract_config.json'), 'w') as file:
-    json.dump(extract_config, file)
-to_be_concatenated_file_names = sorted(list(extract_config['tbc_file_extracted_frames'].keys()))
-all_files_in_env_scan = sorted(os.listdir(os.path.join(source, 'environment_scan')))
-environment_scan_file_names = []
-for file in all_files_in_env_scan:
-    if file[0] != '.' and (file.split('.')[-1] in video_file_suffix or file.split('.')[-1] in image_file_suffix) and os.path.isfile(os.path.join(source, 'environment_scan', file)):
-        environment_scan_file_names.append(file)
-video_frame_extraction_dir = os.path.join(source, 'environment_scan', 'images')
-os.makedirs(video_frame_extraction_dir, exist_ok=True)
-
-# Create to_be_concatenated_video_info.json
-to_be_concatenated_video_info_dict_template = {'frame_names':[], 'frame_ts':[]}
-to_be_concatenated_video_info = {}
-for to_be_concatenated_video_i in range(len(to_be_concatenated_file_names)):
-    to_be_concatenated_video_info[to_be_concatenated_file_names[to_be_concatenated_video_i]] = deepcopy(to_be_concatenated_video_info_dict_template)
 
 # Helper function to make custom matching perform exhaustive matching between extracted frames and all other frames
 def write_match_list_for_file(img_list_file, extracted_frame_lists, match_range=5):
@@ -61,18 +36,81 @@ def write_match_list_for_file(img_list_file, extracted_frame_lists, match_range=
             for img_file in other_video_frames:
                 img_list_file.write(cur_extracted_frame_name + " " + img_file + "\n")
 
-# Prepare fields and files
-img_list_file_path_str = os.path.join(source, 'environment_scan', 'extracted_frames_match_list.txt')
-img_list_file = open(img_list_file_path_str, 'w')
-extracted_frame_names_lists = []
 
-# Extract frames from to-be-concatenated videos
-for to_be_concatenated_file_i in range(len(to_be_concatenated_file_names)):
+# Helper function to read the frames at the sorted frame_is of a video, yields (frame_i, ret, frame) like video_capture.read()
+# The video is walked once with grab(), only the extracted frames are retrieve()d, and the capture only seeks over long gaps
+def read_frames(video_capture, frame_is):
+    next_frame_i = 0
+    for frame_i in frame_is:
+        if next_frame_i is None or frame_i < next_frame_i or frame_i - next_frame_i > max_num_frame_to_decode_instead_of_seeking:
+            video_capture.set(cv2.CAP_PROP_POS_FRAMES, frame_i)
+            next_frame_i = frame_i
+        ret = True
+        while ret and next_frame_i <= frame_i:
+            ret = video_capture.grab()
+            next_frame_i += 1
+        frame = None
+        if ret:
+            ret, frame = video_capture.retrieve()
+        else:
+            # Where the capture is after a failed grab is unknown, so seek for the next frame
+            next_frame_i = None
+        yield frame_i, ret, frame
+
+
+# Helper function to encode a frame as the downscaled base64 JPEG shown by the frontend
+def get_frontend_thumbnail(frame, width, height):
+    frame = cv2.resize(frame, (int(width/4), int(height/4)))
+    ret, buffer = cv2.imencode('.jpg', frame)
+    return base64.b64encode(buffer.tobytes()).decode('utf-8')
+
+
+# Helper function to write the frames at frame_is of a video as JPEGs named by frame_name_of(frame_i) into output_dir,
+# and to make the frontend thumbnails of the frames at thumbnail_frame_is from the same decoded frames
+# Frames are encoded by a thread pool while the next ones are decoded, return the frame_is that are extracted and the
+# thumbnails, or None for the thumbnails if any of their frames cannot be read
+def write_frames(video_capture, frame_is, frame_name_of, output_dir, video_file_name, thumbnail_frame_is=[]):
+    frame_is_to_write = set(frame_is)
+    thumbnail_frame_is = set(thumbnail_frame_is)
+    width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    extracted_frame_is = []
+    writes = []
+    thumbnails = []
+    is_all_thumbnail_read = True
+    num_free_slot = threading.BoundedSemaphore(max_num_frame_waiting_to_be_written)
+    with ThreadPoolExecutor(max_workers=num_jpeg_writer_per_video) as jpeg_writer:
+        for frame_i, ret, frame in read_frames(video_capture, sorted(frame_is_to_write | thumbnail_frame_is)):
+            if not ret:
+                if frame_i in frame_is_to_write:
+                    print(f"Frame {frame_i} of {video_file_name} cannot be extracted.")
+                if frame_i in thumbnail_frame_is:
+                    is_all_thumbnail_read = False
+                continue
+            if frame_i in frame_is_to_write:
+                num_free_slot.acquire()
+                writes.append(jpeg_writer.submit(cv2.imwrite, os.path.join(output_dir, frame_name_of(frame_i)), frame))
+                writes[-1].add_done_callback(lambda _: num_free_slot.release())
+                extracted_frame_is.append(frame_i)
+            if frame_i in thumbnail_frame_is:
+                num_free_slot.acquire()
+                thumbnails.append(jpeg_writer.submit(get_frontend_thumbnail, frame, width, height))
+                thumbnails[-1].add_done_callback(lambda _: num_free_slot.release())
+    # Raise the error of any failed write here
+    for write in writes:
+        write.result()
+    if not is_all_thumbnail_read:
+        return extracted_frame_is, None
+    return extracted_frame_is, [thumbnail.result() for thumbnail in thumbnails]
+
+
+# Extract frames from one to-be-concatenated video, return the names and timestamps of the extracted frames
+# The frontend thumbnails of all frames are made in the same pass and pickled into frontend_frame_dir,
+# which extract_frames_for_frontend.py and the server would otherwise decode the video again for
+def extract_tbc_video_frames(source, to_be_concatenated_file_name, cur_file_extract_config, tbc_extraction_fps, num_frames_to_extract_at_start_and_end, video_frame_extraction_dir, frontend_frame_dir):
     # Read info
-    to_be_concatenated_file_name = to_be_concatenated_file_names[to_be_concatenated_file_i]
     to_be_concatenated_full_file_name = os.path.join(source, 'to_be_concatenated', to_be_concatenated_file_name)
     print(to_be_concatenated_full_file_name)
-    cur_file_extract_config = extract_config['tbc_file_extracted_frames'][to_be_concatenated_file_name]
 
     # Calculate needed constants
     video_capture = cv2.VideoCapture(to_be_concatenated_full_file_name)
@@ -82,9 +120,6 @@ for to_be_concatenated_file_i in range(len(to_be_concatenated_file_names)):
 
     # Find to-be-extracted frames based on config
     to_be_extracted_frame_is = []
-    num_frames_to_extract_at_start_and_end = int(args.num_extracted_frame_for_tbc_videos_at_two_ends)
-    if num_frames_to_extract_at_start_and_end == -1:
-        num_frames_to_extract_at_start_and_end = int(extract_config['final_video_fps'])
     if 'all' in cur_file_extract_config:
         to_be_extracted_frame_is += [i for i in range(min(total_frames, num_frames_to_extract_at_start_and_end))]
         next_to_be_extracted_frame_i = to_be_extracted_frame_is[-1]
@@ -103,29 +138,30 @@ for to_be_concatenated_file_i in range(len(to_be_concatenated_file_names)):
                 next_frame_of_last_extracted_frame = 0
             last_extracted_frame_i = max(0, next_frame_of_last_extracted_frame, total_frames-num_frames_to_extract_at_start_and_end)
             to_be_extracted_frame_is += [i for i in range(last_extracted_frame_i, total_frames)]
-    
-    # Actually extract frames
-    cur_video_extracted_frames = []
-    for frame_i in to_be_extracted_frame_is:
-        video_capture.set(cv2.CAP_PROP_POS_FRAMES, frame_i)
-        ret, frame = video_capture.read()
-        if ret:
-            frame_file_name = 'to_be_concatenated_' + to_be_concatenated_file_name[::-1].split('.', 1)[-1][::-1] +  "_{:08d}".format(frame_i) + '.jpg'
-            cv2.imwrite(os.path.join(video_frame_extraction_dir, frame_file_name), frame)
-            to_be_concatenated_video_info[to_be_concatenated_file_name]['frame_names'].append(frame_file_name)
-            to_be_concatenated_video_info[to_be_concatenated_file_name]['frame_ts'].append((frame_i) / fps)
-            cur_video_extracted_frames.append(frame_file_name)
-        else:
-            print(f"Frame {frame_i} of {to_be_concatenated_file_name} cannot be extracted.")
-    extracted_frame_names_lists.append(cur_video_extracted_frames)
 
+    # Actually extract frames
+    frame_name_of = lambda frame_i: 'to_be_concatenated_' + to_be_concatenated_file_name[::-1].split('.', 1)[-1][::-1] +  "_{:08d}".format(frame_i) + '.jpg'
+    extracted_frame_is, thumbnails = write_frames(video_capture, to_be_extracted_frame_is, frame_name_of, video_frame_extraction_dir, to_be_concatenated_file_name, range(total_frames))
     video_capture.release()
 
+    # The pickle only appears once it is complete, since extract_frames_for_frontend.py skips videos that have one
+    frontend_frame_path = os.path.join(frontend_frame_dir, to_be_concatenated_file_name+'.pickle')
+    if thumbnails is None:
+        print(f"Some frames of {to_be_concatenated_file_name} cannot be read, leaving its frontend frames to extract_frames_for_frontend.py.")
+        # A pickle of an earlier extraction would make extract_frames_for_frontend.py skip the video and show outdated frames
+        if os.path.exists(frontend_frame_path):
+            os.remove(frontend_frame_path)
+    else:
+        with open(frontend_frame_path + '.temp', 'wb') as file:
+            pickle.dump(thumbnails, file)
+        os.replace(frontend_frame_path + '.temp', frontend_frame_path)
+
+    return [frame_name_of(frame_i) for frame_i in extracted_frame_is], [frame_i / fps for frame_i in extracted_frame_is]
 
-# Extract frames from environment scan videos
-for environment_scan_file_i in range(len(environment_scan_file_names)):
+
+# Extract frames from one environment scan video or image, return the names of the extracted frames
+def extract_env_scan_frames(source, environment_scan_file_name, env_scan_extraction_fps, video_frame_extraction_dir):
     # Read info
-    environment_scan_file_name = environment_scan_file_names[environment_scan_file_i]
     environment_scan_full_file_name = os.path.join(source, 'environment_scan', environment_scan_file_name)
     print(environment_scan_full_file_name)
 
@@ -133,8 +169,7 @@ for environment_scan_file_i in range(len(environment_scan_file_names)):
         frame = cv2.imread(environment_scan_full_file_name)
         frame_file_name = 'environment_scan_' + environment_scan_file_name[::-1].split('.', 1)[-1][::-1] + '.jpg'
         cv2.imwrite(os.path.join(video_frame_extraction_dir, frame_file_name), frame)
-        extracted_frame_names_lists.append([frame_file_name])
-        continue
+        return [frame_file_name]
 
     # Calculate needed constants
     video_capture = cv2.VideoCapture(environment_scan_full_file_name)
@@ -149,26 +184,83 @@ for environment_scan_file_i in range(len(environment_scan_file_names)):
         to_be_extracted_frame_is.append(int(next_to_be_extracted_frame_i))
         next_to_be_extracted_frame_i += extract_every_x_frame
 
-    
     # Actually extract frames
-    cur_video_extracted_frames = []
-    for frame_i in to_be_extracted_frame_is:
-        video_capture.set(cv2.CAP_PROP_POS_FRAMES, frame_i)
-        ret, frame = video_capture.read()
-        if ret:
-            frame_file_name = 'environment_scan_' + environment_scan_file_name[::-1].split('.', 1)[-1][::-1] +  "_{:08d}".format(frame_i) + '.jpg'
-            cv2.imwrite(os.path.join(video_frame_extraction_dir, frame_file_name), frame)
-            cur_video_extracted_frames.append(frame_file_name)
-        else:
-            print(f"Frame {frame_i} of {environment_scan_file_name} cannot be extracted.")
-    extracted_frame_names_lists.append(cur_video_extracted_frames)
-
+    frame_name_of = lambda frame_i: 'environment_scan_' + environment_scan_file_name[::-1].split('.', 1)[-1][::-1] +  "_{:08d}".format(frame_i) + '.jpg'
+    extracted_frame_is, _ = write_frames(video_capture, to_be_extracted_frame_is, frame_name_of, video_frame_extraction_dir, environment_scan_file_name)
     video_capture.release()
 
+    return [frame_name_of(frame_i) for frame_i in extracted_frame_is]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser("Extract Environment Scan and To-be-concatenated Video Frames")
+    parser.add_argument("--source_path", "-s", required=True, type=str)
+    parser.add_argument("--num_extracted_frame_per_sec_for_tbc_videos", "-tbcfps", default="10", type=str)
+    parser.add_argument("--num_extracted_frame_for_tbc_videos_at_two_ends", "-tbctef", default="-1", type=str)
+    parser.add_argument("--num_extracted_frame_per_sec_for_env_scan_videos", "-esfps", default="2", type=str)
+    parser.add_argument("--workers", "-w", default=os.cpu_count(), type=int, help="Number of videos decoded in parallel processes, all cores by default")
+    args = parser.parse_args()
+
+    # Format source path
+    source = args.source_path
+    source = source.replace("\\", "/")
+
+    # Read extraction fps
+    tbc_extraction_fps = float(args.num_extracted_frame_per_sec_for_tbc_videos)
+    env_scan_extraction_fps = float(args.num_extracted_frame_per_sec_for_env_scan_videos)
+
+    # Scan to-be-concatenated videos and prepare dir for frames
+    with open(os.path.join(source, 'to_be_concatenated/extract_config.json'), 'r') as file:
+        extract_config = json.load(file)
+    extract_config['original_sampling_interval_sec'] = 1/tbc_extraction_fps
+    with open(os.path.join(source, 'to_be_concatenated/extract_config.json'), 'w') as file:
+        json.dump(extract_config, file)
+    to_be_concatenated_file_names = sorted(list(extract_config['tbc_file_extracted_frames'].keys()))
+    all_files_in_env_scan = sorted(os.listdir(os.path.join(source, 'environment_scan')))
+    environment_scan_file_names = []
+    for file in all_files_in_env_scan:
+        if file[0] != '.' and (file.split('.')[-1] in video_file_suffix or file.split('.')[-1] in image_file_suffix) and os.path.isfile(os.path.join(source, 'environment_scan', file)):
+            environment_scan_file_names.append(file)
+    video_frame_extraction_dir = os.path.join(source, 'environment_scan', 'images')
+    os.makedirs(video_frame_extraction_dir, exist_ok=True)
+    frontend_frame_dir = os.path.join(source, 'to_be_concatenated', 'for_frontend')
+    os.makedirs(frontend_frame_dir, exist_ok=True)
+    num_frames_to_extract_at_start_and_end = int(args.num_extracted_frame_for_tbc_videos_at_two_ends)
+    if num_frames_to_extract_at_start_and_end == -1:
+        num_frames_to_extract_at_start_and_end = int(extract_config['final_video_fps'])
+
+    # Create to_be_concatenated_video_info.json
+    to_be_concatenated_video_info_dict_template = {'frame_names':[], 'frame_ts':[]}
+    to_be_concatenated_video_info = {}
+    for to_be_concatenated_video_i in range(len(to_be_concatenated_file_names)):
+        to_be_concatenated_video_info[to_be_concatenated_file_names[to_be_concatenated_video_i]] = deepcopy(to_be_concatenated_video_info_dict_template)
+
+    # Prepare fields and files
+    img_list_file_path_str = os.path.join(source, 'environment_scan', 'extracted_frames_match_list.txt')
+    img_list_file = open(img_list_file_path_str, 'w')
+    extracted_frame_names_lists = []
+
+    # Extract frames from to-be-concatenated videos and environment scan videos, different videos in different processes.
+    # Results are collected in the order the videos are submitted, so the outputs do not depend on which video finishes first
+    num_workers = max(1, min(args.workers or 1, len(to_be_concatenated_file_names) + len(environment_scan_file_names)))
+    with ProcessPoolExecutor(max_workers=num_workers) as video_extractor:
+        tbc_results = [video_extractor.submit(extract_tbc_video_frames, source, to_be_concatenated_file_name, extract_config['tbc_file_extracted_frames'][to_be_concatenated_file_name], \
+                                              tbc_extraction_fps, num_frames_to_extract_at_start_and_end, video_frame_extraction_dir, frontend_frame_dir) \
+                       for to_be_concatenated_file_name in to_be_concatenated_file_names]
+        env_scan_results = [video_extractor.submit(extract_env_scan_frames, source, environment_scan_file_name, env_scan_extraction_fps, video_frame_extraction_dir) \
+                            for environment_scan_file_name in environment_scan_file_names]
+
+        for to_be_concatenated_file_name, tbc_result in zip(to_be_concatenated_file_names, tbc_results):
+            frame_names, frame_ts = tbc_result.result()
+            to_be_concatenated_video_info[to_be_concatenated_file_name]['frame_names'] = frame_names
+            to_be_concatenated_video_info[to_be_concatenated_file_name]['frame_ts'] = frame_ts
+            extracted_frame_names_lists.append(frame_names)
+        for env_scan_result in env_scan_results:
+            extracted_frame_names_lists.append(env_scan_result.result())
 
-write_match_list_for_file(img_list_file, extracted_frame_names_lists)
-img_list_file.close()
 
-with open(os.path.join(source, "to_be_concatenated", "to_be_concatenated_video_info.json"), "w+") as file:
-    json.dump(to_be_concatenated_video_info, file)
+    write_match_list_for_file(img_list_file, extracted_frame_names_lists)
+    img_list_file.close()
 
+    with open(os.path.join(source, "to_be_concatenated", "to_be_concatenated_video_info.json"), "w+") as file:
+        json.dump(to_be_concatenated_video_info, file)
@@ -0,0 +1,57 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src_backend'))
+
+import server
+
+
+def make_video_info(video_name, start_pos, direction, num_frame, fps):
+    '''
+    Build a to-be-concatenated video entry for a camera moving along a gentle curve
+    '''
+    frame_names = [server.get_frame_name(None, video_name, frame_index, 'jpg') for frame_index in range(num_frame)]
+    frame_pos = [(np.array(start_pos) + frame_index * np.array(direction) + frame_index**2 * np.array([0.0, 0.002, 0.001])).tolist() for frame_index in range(num_frame)]
+    frame_rot = [[0.0, 0.0, 0.0] for _ in range(num_frame)]
+    frame_ts = [frame_index / fps for frame_index in range(num_frame)]
+    return {'frame_names': frame_names, 'frame_pos': frame_pos, 'frame_rot': frame_rot, 'frame_ts': frame_ts,
+            'start_considered_range': [0, 5], 'end_considered_range': [num_frame-5, num_frame],
+            'real_frames': frame_names, 'real_frame_pos': frame_pos, 'real_frame_rot': [np.eye(3).tolist() for _ in range(num_frame)], 'real_frame_ts': frame_ts}
+
+
+@pytest.fixture
+def concatenation_server(tmp_path, monkeypatch):
+    fps = 30
+    tbc_video_info = {'cam_intrinsic_params': [500.0, 500.0, 640, 480],
+                      'a.mp4': make_video_info('a.mp4', [0.0, 0.0, 0.0], [0.05, 0.0, 0.0], 20, fps),
+                      'b.mp4': make_video_info('b.mp4', [2.0, 0.5, 0.0], [0.05, 0.0, 0.0], 20, fps)}
+    monkeypatch.setattr(server, 'up_vec', np.array([0.0, 0.0, 1.0]))
+    monkeypatch.setattr(server, 'final_video_fps', fps)
+    monkeypatch.setattr(server, 'original_sampling_interval_sec', 1/fps)
+    monkeypatch.setattr(server, 'project_path', str(tmp_path))
+    monkeypatch.setattr(server, 'tbc_video_info', tbc_video_info)
+    monkeypatch.setattr(server, 'tbc_stabilizers', {})
+    monkeypatch.setattr(server, 'tbc_scrub_interpolators', {})
+    monkeypatch.setattr(server, 'tbc_registered_ts', {})
+    monkeypatch.setattr(server, 'tbc_max_stabilization_strength_tables', {})
+    return server.app.test_client()
+
+
+def test_concatenate_video_samples_concatenation_clip(concatenation_server, tmp_path):
+    response = concatenation_server.post('/concatenate_video', json={'concatenation_order': ['a.mp4', 'b.mp4']})
+    assert response.status_code == 200, response.get_json()
+    result = response.get_json()
+
+    assert len(result['pos']) == len(result['rot']) == len(result['ts']) == len(result['frames'])
+    assert np.all(np.diff(result['ts']) > 0)
+    # The concatenation clip is the only part without real frames
+    clip_pos = np.array([pos for pos, frame in zip(result['pos'], result['frames']) if frame is None and pos is not None])
+    assert len(clip_pos) > 0
+    assert np.all(np.isfinite(clip_pos))
+    clip_rot = np.array([rot for rot, frame in zip(result['rot'], result['frames']) if frame is None and rot is not None])
+    assert np.allclose(clip_rot @ np.transpose(clip_rot, (0, 2, 1)), np.eye(3), atol=1e-6)
+
+    assert os.path.isfile(os.path.join(str(tmp_path), server.mega_video_name, 'final_video_config.json'))